@@ -0,0 +1,131 @@
+"""
+Benchmarks for writing, reading and comparing data in each of the formats in
+``FORMATS``, for arrays from 1 KB to 1 GB.
+
+Each format is given the kind of data it stores (arrays, dicts of arrays,
+DataFrames, Arrow tables or sparse matrices). Combinations that are not
+available (missing optional dependencies) or that would take too long (1 GB
+in the ``text`` format) are skipped.
+"""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from pytest_arraydiff.plugin import FORMATS, _write_atomic
+
+SIZES = [1024, 1024 ** 2, 1024 ** 3]
+
+DTYPES = ['float64', 'int32']
+
+
+def make_data(file_format, size, dtype, offset=0):
+    """
+    Return data of about ``size`` bytes suitable for ``file_format``.
+    """
+    n_values = max(size // np.dtype(dtype).itemsize // 8, 1) * 8
+    array = (np.arange(n_values) % 1000).astype(dtype).reshape((-1, 8)) + offset
+    columns = [f'col{index}' for index in range(8)]
+    if file_format == 'pd_hdf':
+        import pandas as pd
+        return pd.DataFrame(array, columns=columns)
+    elif file_format == 'npz':
+        return {name: array[:, index] for index, name in enumerate(columns)}
+    elif file_format == 'arrow':
+        import pyarrow as pa
+        return pa.table({name: array[:, index] for index, name in enumerate(columns)})
+    elif file_format == 'sparse':
+        from scipy import sparse
+        return sparse.csr_matrix(array)
+    return array
+
+
+def check_available(file_format, size):
+    try:
+        if file_format == 'fits':
+            import astropy  # noqa: F401
+        elif file_format == 'pd_hdf':
+            import pandas  # noqa: F401
+            import tables  # noqa: F401
+        elif file_format == 'arrow':
+            import pyarrow  # noqa: F401
+        elif file_format == 'sparse':
+            import scipy  # noqa: F401
+    except ImportError:
+        raise NotImplementedError(f"{file_format} dependencies not installed")
+    if file_format == 'text' and size > 1024 ** 2 * 64:
+        raise NotImplementedError("text format too slow for this size")
+
+
+class Formats:
+    """
+    Write and read throughput and peak memory.
+    """
+
+    params = (list(FORMATS), SIZES, DTYPES)
+    param_names = ['file_format', 'size', 'dtype']
+    timeout = 600
+
+    def setup(self, file_format, size, dtype):
+        self.tmpdir = tempfile.mkdtemp()
+        check_available(file_format, size)
+        self.data = make_data(file_format, size, dtype)
+        extension = FORMATS[file_format].extension
+        self.reference_file = os.path.join(self.tmpdir, 'reference.' + extension)
+        self.test_file = os.path.join(self.tmpdir, 'test.' + extension)
+        FORMATS[file_format].write(self.reference_file, self.data)
+
+    def teardown(self, file_format, size, dtype):
+        shutil.rmtree(self.tmpdir)
+
+    def time_write(self, file_format, size, dtype):
+        _write_atomic(file_format, self.test_file, self.data, {})
+
+    def time_read(self, file_format, size, dtype):
+        FORMATS[file_format].read(self.reference_file)
+
+    def time_read_reference(self, file_format, size, dtype):
+        FORMATS[file_format].read_reference(self.reference_file)
+
+    def peakmem_write(self, file_format, size, dtype):
+        _write_atomic(file_format, self.test_file, self.data, {})
+
+    def peakmem_read_reference(self, file_format, size, dtype):
+        FORMATS[file_format].read_reference(self.reference_file)
+
+
+class Compare:
+    """
+    Comparison throughput and peak memory, for data that match the reference
+    and data that do not.
+    """
+
+    params = (list(FORMATS), SIZES, DTYPES, ['pass', 'fail'])
+    param_names = ['file_format', 'size', 'dtype', 'outcome']
+    timeout = 600
+
+    def setup(self, file_format, size, dtype, outcome):
+        self.tmpdir = tempfile.mkdtemp()
+        check_available(file_format, size)
+        extension = FORMATS[file_format].extension
+        self.reference_file = os.path.join(self.tmpdir, 'reference.' + extension)
+        self.test_file = os.path.join(self.tmpdir, 'test.' + extension)
+        FORMATS[file_format].write(self.reference_file, make_data(file_format, size, dtype))
+        self.data = make_data(file_format, size, dtype, offset=0 if outcome == 'pass' else 1)
+        FORMATS[file_format].write(self.test_file, self.data)
+
+    def teardown(self, file_format, size, dtype, outcome):
+        shutil.rmtree(self.tmpdir)
+
+    def time_compare_data(self, file_format, size, dtype, outcome):
+        reference = FORMATS[file_format].read_reference(self.reference_file)
+        FORMATS[file_format].compare_data(reference, self.data, atol=0, rtol=1e-7)
+
+    def time_compare(self, file_format, size, dtype, outcome):
+        FORMATS[file_format].compare(self.reference_file, self.test_file, atol=0, rtol=1e-7)
+
+    def peakmem_compare_data(self, file_format, size, dtype, outcome):
+        reference = FORMATS[file_format].read_reference(self.reference_file)
+        FORMATS[file_format].compare_data(reference, self.data, atol=0, rtol=1e-7)
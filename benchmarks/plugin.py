@@ -0,0 +1,81 @@
+"""
+End-to-end benchmarks of the overhead that the plugin adds to each test, for
+the ``array_compare`` marker and fixture.
+
+pytest is run in a subprocess, so the timings include the startup of the
+interpreter and of pytest; ``time_disabled`` gives the baseline to subtract.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+
+N_TESTS = 100
+
+TEST_MARKER = """
+import pytest
+import numpy as np
+
+@pytest.mark.array_compare(file_format='{file_format}')
+@pytest.mark.parametrize('index', range({n_tests}))
+def test_marker(index):
+    return np.arange(100.).reshape((10, 10)) + index
+"""
+
+TEST_FIXTURE = """
+import pytest
+import numpy as np
+
+@pytest.mark.parametrize('index', range({n_tests}))
+def test_fixture(array_compare, index):
+    array_compare.check(np.arange(100.).reshape((10, 10)) + index, file_format='{file_format}')
+"""
+
+
+def timeraw_import():
+    """
+    Time to import the plugin module, which pytest does at startup even when
+    ``--arraydiff`` is not given.
+    """
+    return "import pytest_arraydiff.plugin", "import pytest"
+
+
+def run_pytest(*args):
+    subprocess.run([sys.executable, '-m', 'pytest', '-qq', '-p', 'no:cacheprovider', *args],
+                   check=True, stdout=subprocess.DEVNULL)
+
+
+class PerTestOverhead:
+    """
+    Time to run ``N_TESTS`` tests that each compare a small array, without
+    and with ``--arraydiff``, and to generate their references.
+    """
+
+    params = (['marker', 'fixture'], ['text', 'npy', 'fits'])
+    param_names = ['api', 'file_format']
+
+    def setup(self, api, file_format):
+        self.tmpdir = tempfile.mkdtemp()
+        self.test_file = os.path.join(self.tmpdir, f'test_{api}.py')
+        self.reference_dir = os.path.join(self.tmpdir, 'reference')
+        template = TEST_MARKER if api == 'marker' else TEST_FIXTURE
+        with open(self.test_file, 'w') as f:
+            f.write(template.format(file_format=file_format, n_tests=N_TESTS))
+        run_pytest(f'--arraydiff-generate-path={self.reference_dir}', self.test_file)
+
+    def teardown(self, api, file_format):
+        shutil.rmtree(self.tmpdir)
+
+    def time_disabled(self, api, file_format):
+        run_pytest(self.test_file)
+
+    def time_disabled_collect(self, api, file_format):
+        run_pytest('--collect-only', self.test_file)
+
+    def time_compare(self, api, file_format):
+        run_pytest('--arraydiff', f'--arraydiff-reference-path={self.reference_dir}', self.test_file)
+
+    def time_generate(self, api, file_format):
+        run_pytest(f'--arraydiff-generate-path={self.reference_dir}', self.test_file)
@@ -28,159 +28,2375 @@
 #
 #   https://github.com/astrofrog/pytest-mpl
 
+import io
 import os
+import re
+import sys
 import abc
 import shutil
 import tempfile
 import warnings
-from urllib.request import urlopen
+import json
+import struct
+import time
+import contextlib
+import threading
+import weakref
+from collections import OrderedDict
+from collections.abc import Iterator
+from urllib.parse import urljoin, urlsplit
 
 import pytest
-import numpy as np
 
 
 abstractstaticmethod = abc.abstractstaticmethod
 abstractclassmethod = abc.abstractclassmethod
 
+# Number of elements compared at a time by _allclose_blockwise
+BLOCK_SIZE = 65536
+
+
+def _allclose_blockwise(reference, data, atol=0., rtol=1e-7, block_size=BLOCK_SIZE):
+    """
+    Check whether ``data`` matches ``reference`` to within the tolerances,
+    with the same semantics as ``np.testing.assert_allclose(reference,
+    data)`` but only returning a boolean.
+
+    Both arrays are walked in blocks of at most ``block_size`` elements and
+    the comparison stops at the first block that is out of tolerance, so the
+    extra memory needed is independent of the size of the arrays.
+    """
+    import numpy as np
+    reference = np.asanyarray(reference)
+    data = np.asanyarray(data)
+
+    if reference.shape != data.shape:
+        return False
+
+    if not all(np.issubdtype(array.dtype, np.number) or array.dtype == bool
+               for array in (reference, data)):
+        try:
+            np.testing.assert_allclose(reference, data, atol=atol, rtol=rtol)
+        except (AssertionError, TypeError):
+            return False
+        else:
+            return True
+
+    blocks = np.nditer([reference, data], flags=['external_loop', 'buffered', 'zerosize_ok'],
+                       op_flags=[['readonly'], ['readonly']], buffersize=block_size, order='C')
+    with blocks:
+        for reference_block, data_block in blocks:
+            if not np.isclose(reference_block, data_block, atol=atol, rtol=rtol, equal_nan=True).all():
+                return False
+    return True
+
 
 class BaseDiff(metaclass=abc.ABCMeta):
 
+    # Whether plain Numpy arrays in this format can be stored in a packed
+    # reference archive (see `ReferenceArchive`) rather than in separate files
+    packable = False
+
+    # Whether this format can store several named arrays, given as a dict, in
+    # a single file. Such formats accept dicts of tolerances by array name.
+    container = False
+
+    # Whether files in this format can be compressed as a whole (see
+    # ``COMPRESSIONS``). ``read`` and ``read_reference`` should then accept
+    # compressed files, whatever their name.
+    compressible = False
+
+    # Whether outputs given as blocks of rows (see ``_blocks``) can be written
+    # and compared one block at a time, without being held in memory in full.
+    # Such formats implement ``write_blocks`` and ``compare_blocks``.
+    streamable = False
+
     @abstractstaticmethod
     def read(filename):
         """
-        Given a filename, return a data object.
+        Given a filename, return a data object.
+        """
+        raise NotImplementedError()
+
+    @abstractstaticmethod
+    def write(filename, data, **kwargs):
+        """
+        Given a filename and a data object (and optional keyword arguments),
+        write the data to a file.
+        """
+        raise NotImplementedError()
+
+    @abstractclassmethod
+    def compare(self, reference_file, test_file, atol=None, rtol=None):
+        """
+        Given a reference and test filename, compare the data to the specified
+        absolute (``atol``) and relative (``rtol``) tolerances.
+
+        Should return two arguments: a boolean indicating whether the data are
+        identical, and a string giving the full error message if not.
+        """
+        raise NotImplementedError()
+
+    @classmethod
+    def read_reference(cls, filename):
+        """
+        Given a reference filename, return the reference in the form expected
+        by ``compare_data``. Defaults to ``read``.
+        """
+        return cls.read(filename)
+
+    @classmethod
+    def compare_data(cls, reference, data, atol=None, rtol=None, write_kwargs=None):
+        """
+        Given a reference (as returned by ``read_reference``) and the data
+        object produced by the test, compare them in memory to the specified
+        absolute (``atol``) and relative (``rtol``) tolerances.
+
+        Should return a boolean indicating whether the data are identical. A
+        `False` result is not final: the caller then writes the data out and
+        uses ``compare`` to decide and to build the error message, so formats
+        that cannot compare in memory can keep this default.
+        """
+        return False
+
+    @staticmethod
+    def roundtrip(data, **kwargs):
+        """
+        Given a data object (and the keyword arguments that would be passed to
+        ``write``), return the array that ``read`` would give back after
+        writing it, without touching the disk.
+        """
+        return data
+
+
+def _tolerance(tolerance, name, default):
+    """
+    Return the tolerance for the array ``name`` of a container, given either a
+    single tolerance or a dict of tolerances by array name.
+    """
+    if isinstance(tolerance, dict):
+        tolerance = tolerance.get(name)
+    return default if tolerance is None else tolerance
+
+
+# Compressions supported for whole reference files, by filename suffix, with
+# the magic bytes by which compressed files are recognized when reading
+COMPRESSIONS = {'gz': b'\x1f\x8b', 'bz2': b'BZh', 'xz': b'\xfd7zXZ\x00'}
+
+
+def _split_compression(filename):
+    """
+    Split ``filename`` into the name of the uncompressed file and the
+    compression given by its suffix (or `None`).
+    """
+    base, _, suffix = str(filename).rpartition('.')
+    if base and suffix in COMPRESSIONS:
+        return base, suffix
+    return str(filename), None
+
+
+def _compression(filename):
+    """
+    Return the compression of the file ``filename`` from its first bytes, or
+    `None` if it is not compressed. Downloaded references do not keep their
+    name, so the suffix cannot be relied on.
+    """
+    with open(filename, 'rb') as f:
+        magic = f.read(max(len(prefix) for prefix in COMPRESSIONS.values()))
+    for compression, prefix in COMPRESSIONS.items():
+        if magic.startswith(prefix):
+            return compression
+    return None
+
+
+def _open(filename, mode='rb', compression=None, **kwargs):
+    """
+    Open ``filename``, compressing or decompressing it in chunks as it is
+    written or read if ``compression`` is given.
+    """
+    if compression == 'gz':
+        import gzip
+        return gzip.open(filename, mode, **kwargs)
+    elif compression == 'bz2':
+        import bz2
+        return bz2.open(filename, mode, **kwargs)
+    elif compression == 'xz':
+        import lzma
+        return lzma.open(filename, mode, **kwargs)
+    return open(filename, mode, **kwargs)
+
+
+def _blocks(data):
+    """
+    Return an iterator over the blocks of rows of a lazy output, or `None` if
+    ``data`` is not one. Lazy outputs are iterators (such as generators)
+    yielding arrays, to be concatenated along their first axis, and chunked
+    arrays (such as Dask, Zarr or h5py arrays), which are read one chunk of
+    rows at a time.
+    """
+    if isinstance(data, Iterator):
+        return data
+    chunks = getattr(data, 'chunks', None)
+    shape = getattr(data, 'shape', ())
+    if isinstance(chunks, tuple) and chunks and len(shape) > 0:
+        # Dask gives the size of each chunk along each axis, Zarr and h5py a
+        # single chunk size per axis
+        rows = chunks[0]
+        if not isinstance(rows, tuple):
+            rows = (rows,) * -(-shape[0] // rows)
+        return _chunk_rows(data, rows)
+    return None
+
+
+def _chunk_rows(data, rows):
+    import numpy as np
+    start = 0
+    for size in rows:
+        yield np.asarray(data[start:start + size])
+        start += size
+
+
+def _checked_blocks(blocks):
+    """
+    Yield the blocks of rows yielded by ``blocks`` as arrays, checking that
+    they can be concatenated along their first axis.
+    """
+    import numpy as np
+    row_shape = None
+    for block in blocks:
+        block = np.asanyarray(block)
+        if block.ndim == 0:
+            raise ValueError("Blocks of rows should be arrays with at least one dimension")
+        if row_shape is None:
+            row_shape = block.shape[1:]
+        elif block.shape[1:] != row_shape:
+            raise ValueError("Blocks of rows should all have the same shape apart from their first "
+                             f"dimension, got {row_shape} and {block.shape[1:]}")
+        yield block
+
+
+def _flat_reader(array):
+    """
+    Return a function giving the next ``count`` elements of ``array`` in C
+    order at each call, or fewer at the end of the array.
+    """
+    import numpy as np
+    flat = np.asanyarray(array).reshape(-1)
+    position = 0
+
+    def read(count):
+        nonlocal position
+        position += count
+        return flat[position - count:position]
+
+    return read
+
+
+class SimpleArrayDiff(BaseDiff):
+
+    packable = True
+    streamable = True
+
+    @classmethod
+    def compare(cls, reference_file, test_file, atol=None, rtol=None):
+        import numpy as np
+
+        array_ref = cls.read(reference_file)
+        array_new = cls.read(test_file)
+
+        try:
+            np.testing.assert_allclose(array_ref, array_new, atol=atol, rtol=rtol)
+        except AssertionError as exc:
+            message = f"\n\na: {test_file}" + '\n'
+            message += f"b: {reference_file}" + '\n'
+            message += exc.args[0]
+            return False, message
+        else:
+            return True, ""
+
+    @classmethod
+    def compare_data(cls, reference, data, atol=None, rtol=None, write_kwargs=None):
+        # Only a pass/fail is needed here; if the arrays do not match, the
+        # mismatch statistics are computed by ``compare`` for the report.
+        return _allclose_blockwise(reference, cls.roundtrip(data, **(write_kwargs or {})),
+                                   atol=atol, rtol=rtol)
+
+    @staticmethod
+    def read_shape(shape):
+        """
+        Return the shape of the array that ``read`` gives back after writing
+        an array of the given shape.
+        """
+        return tuple(shape)
+
+    @classmethod
+    def compare_blocks(cls, reference, blocks, atol=None, rtol=None, write_kwargs=None):
+        """
+        Given a reference (as returned by ``read_reference``) and an iterator
+        over blocks of rows, compare the blocks to the reference one at a time
+        as if they had been concatenated along their first axis. All the
+        blocks are consumed, so that the shape of the output is known.
+
+        Returns a boolean indicating whether the data are identical, and a
+        string describing the first difference if not.
+        """
+        import numpy as np
+        write_kwargs = write_kwargs or {}
+        if isinstance(reference, CompressedNPY):
+            elements = reference.elements()
+        else:
+            elements = contextlib.nullcontext((np.shape(reference), _flat_reader(reference)))
+        rows, row_shape, message = 0, (), None
+        with elements as (shape, read):
+            for block in _checked_blocks(blocks):
+                row_shape = block.shape[1:]
+                if message is None:
+                    values = np.ravel(cls.roundtrip(block, **write_kwargs))
+                    expected = read(values.size)
+                    if not _allclose_blockwise(expected, values, atol=atol, rtol=rtol):
+                        try:
+                            np.testing.assert_allclose(expected, values, atol=atol, rtol=rtol)
+                        except AssertionError as exc:
+                            message = f"Rows {rows} to {rows + len(block) - 1} differ:" + exc.args[0]
+                rows += len(block)
+        shape_new = cls.read_shape((rows,) + row_shape)
+        if shape_new != tuple(shape):
+            return False, f"Shapes differ: {shape_new} (a) != {tuple(shape)} (b)"
+        if message is not None:
+            return False, message
+        return True, ""
+
+
+class FITSDiff(BaseDiff):
+
+    extension = 'fits'
+    packable = True
+    container = True
+    # Astropy recognizes compressed files by their first bytes
+    compressible = True
+
+    @staticmethod
+    def read(filename):
+        from astropy.io import fits
+        return fits.getdata(filename)
+
+    @staticmethod
+    def _to_hdulist(data):
+        # Dicts of arrays are stored as image extensions named after the keys
+        import numpy as np
+        from astropy.io import fits
+        if isinstance(data, dict):
+            return fits.HDUList([fits.PrimaryHDU()] + [fits.ImageHDU(array, name=name)
+                                                       for name, array in data.items()])
+        if isinstance(data, np.ndarray):
+            data = fits.PrimaryHDU(data)
+        if not isinstance(data, fits.HDUList):
+            data = fits.HDUList([data])
+        return data
+
+    @classmethod
+    def write(cls, filename, data, **kwargs):
+        return cls._to_hdulist(data).writeto(filename, **kwargs)
+
+    @staticmethod
+    def read_reference(filename):
+        from astropy.io import fits
+        # Memory-map the reference so that only the data that is compared
+        # gets paged in. astropy drops memory-mapped data when the file is
+        # closed, so hold on to it and attach it again afterwards (the mapping
+        # stays valid for as long as the arrays are referenced).
+        try:
+            with fits.open(filename, memmap=True) as hdulist:
+                data = [hdu.data for hdu in hdulist]
+        except ValueError:
+            # Scaled images (BZERO/BSCALE/BLANK) cannot be memory-mapped
+            with fits.open(filename, memmap=False) as hdulist:
+                for hdu in hdulist:
+                    hdu.data  # load the data before the file is closed
+            return hdulist
+        for hdu, hdu_data in zip(hdulist, data):
+            hdu.data = hdu_data
+        return hdulist
+
+    @staticmethod
+    def _diff(a, b, atol=None, rtol=None):
+        import astropy
+        from astropy.io.fits.diff import FITSDiff
+        from astropy.utils.introspection import minversion
+        if minversion(astropy, '2.0'):
+            return FITSDiff(a, b, rtol=rtol, atol=atol)
+        else:
+            # `atol` is not supported prior to Astropy 2.0
+            return FITSDiff(a, b, tolerance=rtol)
+
+    @classmethod
+    def _diff_hdus(cls, a, b, atol=None, rtol=None):
+        """
+        Compare the HDULists ``a`` and ``b`` one extension at a time, with the
+        tolerances for each extension looked up by name in the ``atol`` and
+        ``rtol`` dicts, and return whether they are identical and a report.
+        """
+        from astropy.io.fits.diff import HDUDiff
+        atol = {name.upper(): value for name, value in atol.items()} if isinstance(atol, dict) else atol
+        rtol = {name.upper(): value for name, value in rtol.items()} if isinstance(rtol, dict) else rtol
+        if [hdu.name for hdu in a] != [hdu.name for hdu in b]:
+            return False, (f"\nExtensions differ: {[hdu.name for hdu in a]} != "
+                           f"{[hdu.name for hdu in b]}\n")
+        identical, report = True, ''
+        for hdu_a, hdu_b in zip(a, b):
+            diff = HDUDiff(hdu_a, hdu_b, atol=_tolerance(atol, hdu_a.name, 0.),
+                           rtol=_tolerance(rtol, hdu_a.name, 1e-7))
+            if not diff.identical:
+                identical = False
+                report += f"\nExtension {hdu_a.name}:\n" + diff.report()
+        return identical, report
+
+    @staticmethod
+    def _identical_hdu(a, b, atol, rtol):
+        """
+        Check whether the HDUs ``a`` and ``b`` are identical, returning `None`
+        if this needs astropy's diff to decide.
+        """
+        import numpy as np
+        from astropy.io import fits
+        supported = (fits.PrimaryHDU, fits.ImageHDU, fits.BinTableHDU, fits.TableHDU)
+        if type(a) is not type(b) or type(a) not in supported:
+            return None
+        # Headers that differ may still be identical within the tolerances
+        if [(card.keyword, card.value, card.comment) for card in a.header.cards] != \
+                [(card.keyword, card.value, card.comment) for card in b.header.cards]:
+            return None
+        if a.data is None or b.data is None:
+            return a.data is None and b.data is None
+        if isinstance(a, (fits.PrimaryHDU, fits.ImageHDU)):
+            columns = [(a.data, b.data)]
+        else:
+            columns = [(a.data.field(name), b.data.field(name)) for name in a.columns.names]
+        for column_a, column_b in columns:
+            if column_a.shape != column_b.shape or column_a.dtype.hasobject or column_b.dtype.hasobject:
+                # Variable-length array columns are left to astropy
+                return None
+            # As for astropy, tolerances only apply to floating-point data
+            # (where astropy also treats NaN and Inf values as equal, so
+            # these can only be a false negative here)
+            if column_a.dtype.kind in 'fc' or column_b.dtype.kind in 'fc':
+                if not _allclose_blockwise(column_a, column_b, atol=atol, rtol=rtol):
+                    return False
+            elif not np.array_equal(column_a, column_b):
+                return False
+        return True
+
+    @classmethod
+    def _identical(cls, a, b, atol=None, rtol=None):
+        """
+        Cheaply check whether the HDULists ``a`` and ``b`` are identical: first
+        their structure, then each pair of HDUs (concurrently for
+        multi-extension files), comparing the data with vectorized tolerance
+        checks and the headers card by card. Returns `None` if astropy's diff
+        is needed to decide, for instance for headers that differ (which may
+        still match within the tolerances) or unusual HDU types.
+        """
+        if len(a) != len(b):
+            return False
+        atol = {name.upper(): value for name, value in atol.items()} if isinstance(atol, dict) else atol
+        rtol = {name.upper(): value for name, value in rtol.items()} if isinstance(rtol, dict) else rtol
+        arguments = [(hdu_a, hdu_b, _tolerance(atol, hdu_a.name, 0.), _tolerance(rtol, hdu_a.name, 1e-7))
+                     for hdu_a, hdu_b in zip(a, b)]
+        if len(arguments) == 1:
+            results = [cls._identical_hdu(*arguments[0])]
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=min(len(arguments), os.cpu_count() or 1),
+                                    thread_name_prefix='arraydiff-fits') as executor:
+                results = list(executor.map(lambda args: cls._identical_hdu(*args), arguments))
+        if False in results:
+            return False
+        if None in results:
+            return None
+        return True
+
+    @classmethod
+    def compare(cls, reference_file, test_file, atol=None, rtol=None):
+        # The full diff report is only built when the files differ
+        if cls._identical(cls.read_reference(reference_file), cls.read_reference(test_file),
+                          atol=atol, rtol=rtol):
+            return True, ""
+        if isinstance(atol, dict) or isinstance(rtol, dict):
+            from astropy.io import fits
+            with fits.open(reference_file) as a, fits.open(test_file) as b:
+                return cls._diff_hdus(a, b, atol=atol, rtol=rtol)
+        diff = cls._diff(reference_file, test_file, atol=atol, rtol=rtol)
+        return diff.identical, diff.report()
+
+    @classmethod
+    def compare_data(cls, reference, data, atol=None, rtol=None, write_kwargs=None):
+        data = cls._to_hdulist(data)
+        identical = cls._identical(reference, data, atol=atol, rtol=rtol)
+        if identical is not None:
+            return identical
+        if isinstance(atol, dict) or isinstance(rtol, dict):
+            return cls._diff_hdus(reference, data, atol=atol, rtol=rtol)[0]
+        return cls._diff(reference, data, atol=atol, rtol=rtol).identical
+
+
+# A single numeric conversion specifier, as accepted by ``np.savetxt``
+TEXT_FORMAT = re.compile(r'%[-+ 0#]*\d*(?:\.\d+)?[diouxXeEfFgG]')
+
+
+class TextDiff(SimpleArrayDiff):
+
+    extension = 'txt'
+    compressible = True
+
+    @staticmethod
+    def read(filename):
+        import numpy as np
+        # np.loadtxt parses in C since Numpy 1.23, reading the file in chunks
+        with _open(filename, 'rb', _compression(filename)) as f:
+            return np.loadtxt(f)
+
+    @staticmethod
+    def _format(data, fmt='%g', delimiter=' ', newline='\n', **kwargs):
+        """
+        Return an iterator over the text that ``np.savetxt`` writes for
+        ``data``, formatting the values of as many rows as fit in
+        ``BLOCK_SIZE`` values in a single operation rather than one row at a
+        time, or `None` for the cases left to ``np.savetxt`` (headers, complex
+        values, per-column formats, and so on).
+        """
+        import numpy as np
+        if kwargs or not isinstance(data, np.ndarray) or data.ndim not in (1, 2) or data.dtype.kind not in 'iuf':
+            return None
+        if not isinstance(fmt, str) or fmt.count('%') != 1 or not TEXT_FORMAT.search(fmt):
+            return None
+        if '%' in delimiter or '%' in newline:
+            return None
+        ncols = 1 if data.ndim == 1 else data.shape[1]
+        row = delimiter.join([fmt] * ncols) + newline
+        rows = max(BLOCK_SIZE // max(ncols, 1), 1)
+        return ((row * len(block)) % tuple(block.ravel().tolist())
+                for block in (data[start:start + rows] for start in range(0, data.shape[0], rows)))
+
+    @staticmethod
+    def write(filename, data, **kwargs):
+        import numpy as np
+        fmt = kwargs.get('fmt', '%g')
+        kwargs['fmt'] = fmt
+        text = TextDiff._format(data, **kwargs)
+        if text is not None:
+            if isinstance(filename, io.TextIOBase):
+                filename.writelines(text)
+                return
+            if isinstance(filename, (str, os.PathLike)) and not str(filename).endswith(('.bz2', '.xz')):
+                import gzip
+                # Same encoding and compression as np.savetxt
+                opener = gzip.open if str(filename).endswith('.gz') else open
+                with opener(filename, 'wt', encoding='latin1') as f:
+                    f.writelines(text)
+                return
+        return np.savetxt(filename, data, **kwargs)
+
+    @staticmethod
+    def write_blocks(filename, blocks, **kwargs):
+        """
+        Write the blocks of rows yielded by ``blocks`` to ``filename`` one
+        block at a time, with any ``header`` before the first block and any
+        ``footer`` after the last.
+        """
+        import numpy as np
+        header = kwargs.pop('header', '')
+        footer = kwargs.pop('footer', '')
+        ncols = 1
+        with open(filename, 'wt', encoding='latin1') as f:
+            for index, block in enumerate(_checked_blocks(blocks)):
+                if index == 0 and header:
+                    TextDiff.write(f, block, header=header, **kwargs)
+                else:
+                    TextDiff.write(f, block, **kwargs)
+                ncols = 1 if block.ndim == 1 else block.shape[1]
+            if footer:
+                np.savetxt(f, np.empty((0, ncols)), footer=footer, **kwargs)
+
+    @staticmethod
+    def read_shape(shape):
+        # np.loadtxt drops the axes of length one
+        return tuple(n for n in shape if n != 1)
+
+    @staticmethod
+    def roundtrip(data, **kwargs):
+        import numpy as np
+        # The text format is lossy (``fmt`` defaults to ``%g``), so the test
+        # array is serialized to a buffer to compare like with like. Where
+        # possible, this is done one block of rows at a time, and the axes of
+        # length one dropped at the end as np.loadtxt does for the whole text.
+        text = TextDiff._format(data, **kwargs)
+        if text is not None and len(data) > 0:
+            return np.squeeze(np.concatenate([np.loadtxt(io.StringIO(block), ndmin=2) for block in text]))
+        buffer = io.StringIO()
+        TextDiff.write(buffer, data, **kwargs)
+        buffer.seek(0)
+        return np.loadtxt(buffer)
+
+
+class CompressedNPY:
+    """
+    A compressed ``.npy`` reference file, which is decompressed in chunks as
+    it is compared rather than read in full.
+    """
+
+    def __init__(self, filename, compression):
+        self.filename = filename
+        self.compression = compression
+
+    @staticmethod
+    def _read_header(f):
+        """
+        Return the shape, order and dtype from the header of the ``.npy`` file
+        ``f``, or `None` for version 3.0 headers, which only np.load reads.
+        """
+        from numpy.lib import format
+        version = format.read_magic(f)
+        if version == (1, 0):
+            return format.read_array_header_1_0(f)
+        elif version == (2, 0):
+            return format.read_array_header_2_0(f)
+        return None
+
+    def allclose(self, data, atol=0., rtol=1e-7, block_size=BLOCK_SIZE):
+        """
+        Check whether ``data`` matches the reference to within the tolerances,
+        as ``_allclose_blockwise`` does, decompressing at most ``block_size``
+        elements at a time.
+        """
+        import numpy as np
+        data = np.asanyarray(data)
+        with _open(self.filename, 'rb', self.compression) as f:
+            header = self._read_header(f)
+            if header is None:
+                return _allclose_blockwise(NPYDiff.read(self.filename), data, atol=atol, rtol=rtol)
+            shape, fortran_order, dtype = header
+            if shape != data.shape:
+                return False
+            if dtype.hasobject:
+                return _allclose_blockwise(NPYDiff.read(self.filename), data, atol=atol, rtol=rtol)
+            flat = data.ravel(order='F' if fortran_order else 'C')
+            for start in range(0, flat.size, block_size):
+                block = flat[start:start + block_size]
+                buffer = f.read(block.size * dtype.itemsize)
+                if len(buffer) != block.size * dtype.itemsize:
+                    raise ValueError(f"{self.filename} is truncated")
+                if not _allclose_blockwise(np.frombuffer(buffer, dtype=dtype), block, atol=atol, rtol=rtol):
+                    return False
+        return True
+
+    @contextlib.contextmanager
+    def elements(self):
+        """
+        Yield the shape of the reference and a function giving its next
+        ``count`` elements in C order at each call (see ``_flat_reader``),
+        decompressed as they are requested.
+        """
+        import numpy as np
+        with _open(self.filename, 'rb', self.compression) as f:
+            header = self._read_header(f)
+            if header is None or header[1] or header[2].hasobject:
+                # Only C-ordered arrays of plain dtypes are read in chunks
+                array = NPYDiff.read(self.filename)
+                yield array.shape, _flat_reader(array)
+                return
+            shape, _, dtype = header
+
+            def read(count):
+                buffer = f.read(count * dtype.itemsize)
+                return np.frombuffer(buffer[:len(buffer) - len(buffer) % dtype.itemsize], dtype=dtype)
+
+            yield shape, read
+
+
+def _npy_header(dtype, shape, size=None):
+    """
+    Return the version 1.0 ``.npy`` header for a C-ordered array, padded with
+    spaces to ``size`` bytes or, by default, so that the data are aligned to
+    64 bytes as in files written by np.save.
+    """
+    from numpy.lib import format
+    fields = {'descr': format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': tuple(shape)}
+    header = ('{' + ''.join(f"{key!r}: {value!r}, " for key, value in fields.items()) + '}').encode('latin1')
+    prefix = len(format.MAGIC_PREFIX) + 2 + 2
+    if size is None:
+        size = -(-(prefix + len(header) + 1) // 64) * 64
+    header += b' ' * (size - prefix - len(header) - 1) + b'\n'
+    return format.magic(1, 0) + struct.pack('<H', len(header)) + header
+
+
+class NPYDiff(SimpleArrayDiff):
+
+    extension = 'npy'
+    compressible = True
+
+    @staticmethod
+    def read(filename):
+        import numpy as np
+        compression = _compression(filename)
+        if compression is None:
+            return np.load(filename, mmap_mode='r')
+        with _open(filename, 'rb', compression) as f:
+            return np.load(f)
+
+    @staticmethod
+    def write(filename, data, **kwargs):
+        import numpy as np
+        return np.save(filename, data, **kwargs)
+
+    @staticmethod
+    def write_blocks(filename, blocks, **kwargs):
+        """
+        Write the blocks of rows yielded by ``blocks`` to ``filename`` as a
+        single array, one block at a time. Since the number of rows is only
+        known at the end, the header is first written with room for the
+        largest possible number and then rewritten. The ``np.save`` options
+        do not apply, as the data are written as they are.
+        """
+        import numpy as np
+        rows, dtype, row_shape, size = 0, None, (), None
+        with open(filename, 'wb') as f:
+            for block in _checked_blocks(blocks):
+                if dtype is None:
+                    if block.dtype.hasobject:
+                        raise ValueError("Blocks of rows of objects cannot be written to .npy files")
+                    dtype, row_shape = block.dtype, block.shape[1:]
+                    size = len(_npy_header(dtype, (sys.maxsize,) + row_shape))
+                    f.seek(size)
+                elif block.dtype != dtype:
+                    raise ValueError(f"Blocks of rows should all have the same dtype, got {dtype} and {block.dtype}")
+                f.write(np.ascontiguousarray(block).data)
+                rows += len(block)
+            f.seek(0)
+            f.write(_npy_header(np.dtype(float) if dtype is None else dtype, (rows,) + row_shape, size))
+
+    @classmethod
+    def read_reference(cls, filename):
+        compression = _compression(filename)
+        if compression is None:
+            return cls.read(filename)
+        return CompressedNPY(filename, compression)
+
+    @classmethod
+    def compare_data(cls, reference, data, atol=None, rtol=None, write_kwargs=None):
+        if isinstance(reference, CompressedNPY):
+            return reference.allclose(data, atol=atol, rtol=rtol)
+        return super().compare_data(reference, data, atol=atol, rtol=rtol, write_kwargs=write_kwargs)
+
+
+class NPZDiff(BaseDiff):
+    """
+    Several named arrays, given as a dict, stored in a single ``.npz`` file.
+    """
+
+    extension = 'npz'
+    container = True
+
+    @staticmethod
+    def read(filename):
+        import numpy as np
+        with np.load(filename) as npz:
+            return {name: npz[name] for name in npz.files}
+
+    @staticmethod
+    def write(filename, data, compressed=False):
+        import numpy as np
+        if not isinstance(data, dict):
+            raise TypeError("The 'npz' format stores several arrays, which should be given as a dict")
+        # Write to a file object, since np.savez appends .npz to filenames
+        with open(filename, 'wb') as f:
+            (np.savez_compressed if compressed else np.savez)(f, **data)
+
+    @classmethod
+    def compare(cls, reference_file, test_file, atol=None, rtol=None):
+        import numpy as np
+
+        arrays_ref = cls.read(reference_file)
+        arrays_new = cls.read(test_file)
+
+        message = ''
+        if set(arrays_ref) != set(arrays_new):
+            message += f"\nArrays only in a: {sorted(set(arrays_new) - set(arrays_ref))}"
+            message += f"\nArrays only in b: {sorted(set(arrays_ref) - set(arrays_new))}\n"
+        for name in sorted(set(arrays_ref) & set(arrays_new)):
+            try:
+                np.testing.assert_allclose(arrays_ref[name], arrays_new[name],
+                                           atol=_tolerance(atol, name, 0.), rtol=_tolerance(rtol, name, 1e-7))
+            except AssertionError as exc:
+                message += f"\nArray '{name}':" + exc.args[0] + '\n'
+        if message:
+            return False, f"\n\na: {test_file}\nb: {reference_file}\n" + message
+        else:
+            return True, ""
+
+    @classmethod
+    def compare_data(cls, reference, data, atol=None, rtol=None, write_kwargs=None):
+        if not isinstance(data, dict) or set(reference) != set(data):
+            return False
+        return all(_allclose_blockwise(reference[name], data[name],
+                                       atol=_tolerance(atol, name, 0.), rtol=_tolerance(rtol, name, 1e-7))
+                   for name in data)
+
+
+class PDHDFDiff(BaseDiff):
+
+    extension = 'h5'
+
+    @staticmethod
+    def read(filename):
+        import pandas as pd
+        return pd.read_hdf(filename)
+
+    @staticmethod
+    def write(filename, data, **kwargs):
+        import pandas as pd  # noqa: F401
+        key = os.path.basename(filename).replace('.h5', '')
+        return data.to_hdf(filename, key=key, **kwargs)
+
+    @classmethod
+    def compare(cls, reference_file, test_file, atol=None, rtol=None):
+        import pandas.testing as pdt
+        import pandas as pd
+
+        ref_data = pd.read_hdf(reference_file)
+        test_data = pd.read_hdf(test_file)
+        try:
+            pdt.assert_frame_equal(ref_data, test_data)
+        except AssertionError as exc:
+            message = f"\n\na: {test_file}" + '\n'
+            message += f"b: {reference_file}" + '\n'
+            message += exc.args[0]
+            return False, message
+        else:
+            return True, ""
+
+    @classmethod
+    def compare_data(cls, reference, data, atol=None, rtol=None, write_kwargs=None):
+        import pandas.testing as pdt
+        try:
+            pdt.assert_frame_equal(reference, data)
+        except AssertionError:
+            return False
+        else:
+            return True
+
+
+class ArrowDiff(BaseDiff):
+    """
+    pandas DataFrames (or Arrow tables, or dicts of 1-d arrays) stored as
+    uncompressed Arrow IPC files, which are memory-mapped and compared one
+    column at a time.
+    """
+
+    extension = 'arrow'
+    container = True
+
+    @staticmethod
+    def _to_table(data):
+        import pyarrow as pa
+        if isinstance(data, pa.Table):
+            return data
+        if isinstance(data, dict):
+            return pa.table(data)
+        # The index is stored as a column so that it is compared like the others
+        return pa.Table.from_pandas(data, preserve_index=True)
+
+    @classmethod
+    def read(cls, filename):
+        return cls.read_reference(filename).to_pandas()
+
+    @classmethod
+    def write(cls, filename, data, compression='uncompressed', **kwargs):
+        from pyarrow import feather
+        return feather.write_feather(cls._to_table(data), filename, compression=compression, **kwargs)
+
+    @staticmethod
+    def read_reference(filename):
+        import pyarrow as pa
+        # The columns of an uncompressed file are views of the memory map, so
+        # only the columns (and rows) that are compared get read from disk
+        return pa.ipc.open_file(pa.memory_map(filename)).read_all()
+
+    @staticmethod
+    def _differences(reference, data, atol=None, rtol=None, report=False):
+        """
+        Compare the Arrow tables ``reference`` and ``data`` one column at a
+        time, with tolerances for numeric columns given either as a single
+        value or as a dict by column name, and yield a description of each
+        difference found (only the name of the column unless ``report`` is
+        set), so that callers can stop at the first difference.
+        """
+        import numpy as np
+        import pyarrow as pa
+
+        if reference.column_names != data.column_names:
+            yield f"Columns differ: {data.column_names} != {reference.column_names}"
+            return
+        if reference.num_rows != data.num_rows:
+            yield f"Number of rows differ: {data.num_rows} != {reference.num_rows}"
+            return
+
+        for name in reference.column_names:
+            column_ref, column_new = reference.column(name), data.column(name)
+            if column_ref.type != column_new.type:
+                yield f"Column '{name}': types differ: {column_new.type} != {column_ref.type}"
+                continue
+            if column_ref.null_count or column_new.null_count:
+                if not column_ref.is_null().equals(column_new.is_null()):
+                    yield f"Column '{name}': missing values differ" if report else name
+                    continue
+            if not (pa.types.is_integer(column_ref.type) or pa.types.is_floating(column_ref.type)):
+                if column_ref.equals(column_new):
+                    continue
+                if report:
+                    values_ref = column_ref.to_numpy(zero_copy_only=False)
+                    values_new = column_new.to_numpy(zero_copy_only=False)
+                    mismatch = np.flatnonzero(values_ref != values_new)
+                    yield (f"Column '{name}': {len(mismatch)} / {len(values_ref)} values differ, "
+                           f"first at row {mismatch[0]}: {values_new[mismatch[0]]!r} != {values_ref[mismatch[0]]!r}")
+                else:
+                    yield name
+                continue
+            column_atol, column_rtol = _tolerance(atol, name, 0.), _tolerance(rtol, name, 1e-7)
+            # Walk the chunks of the reference, which are zero-copy views of
+            # the file, and the matching slices of the test column
+            offset = 0
+            for chunk in column_ref.chunks:
+                chunk_new = column_new.slice(offset, len(chunk))
+                offset += len(chunk)
+                if not _allclose_blockwise(chunk.to_numpy(zero_copy_only=False),
+                                           chunk_new.to_numpy(), atol=column_atol, rtol=column_rtol):
+                    break
+            else:
+                continue
+            if report:
+                try:
+                    np.testing.assert_allclose(column_ref.to_numpy(), column_new.to_numpy(),
+                                               atol=column_atol, rtol=column_rtol)
+                except AssertionError as exc:
+                    yield f"Column '{name}':" + exc.args[0]
+            else:
+                yield name
+
+    @classmethod
+    def compare(cls, reference_file, test_file, atol=None, rtol=None):
+        differences = list(cls._differences(cls.read_reference(reference_file), cls.read_reference(test_file),
+                                            atol=atol, rtol=rtol, report=True))
+        if differences:
+            return False, f"\n\na: {test_file}\nb: {reference_file}\n\n" + '\n'.join(differences) + '\n'
+        else:
+            return True, ""
+
+    @classmethod
+    def compare_data(cls, reference, data, atol=None, rtol=None, write_kwargs=None):
+        return next(cls._differences(reference, cls._to_table(data), atol=atol, rtol=rtol), None) is None
+
+
+class SparseDiff(BaseDiff):
+    """
+    Two-dimensional ``scipy.sparse`` arrays or matrices, stored with
+    ``scipy.sparse.save_npz`` and compared without densifying them.
+    """
+
+    extension = 'npz'
+
+    @staticmethod
+    def read(filename):
+        from scipy import sparse
+        return sparse.load_npz(filename)
+
+    @staticmethod
+    def write(filename, data, compressed=False):
+        from scipy import sparse
+        if not sparse.issparse(data):
+            raise TypeError("The 'sparse' format stores scipy.sparse arrays or matrices")
+        # Write to a file object, since save_npz appends .npz to filenames
+        with open(filename, 'wb') as f:
+            sparse.save_npz(f, data, compressed=compressed)
+
+    @staticmethod
+    def _aligned(reference, data):
+        """
+        Return the positions (as flat indices in C order) stored in either of
+        the sparse arrays ``reference`` and ``data``, which must have the same
+        shape, and the values of each array at these positions, with zeros
+        where a position is only stored in the other array. Cells stored in
+        neither are zero in both, so comparing these values is equivalent to
+        comparing the dense arrays.
+        """
+        import numpy as np
+        positions, values = [], []
+        for array in (reference, data):
+            array = array.tocoo()
+            # Duplicate entries add up, as when converting to a dense array
+            array.sum_duplicates()
+            positions.append(np.ravel_multi_index((array.row, array.col), array.shape))
+            values.append(array.data)
+        if np.array_equal(*positions):
+            # The usual case of arrays with the same sparsity structure
+            return positions[0], values
+        union = np.union1d(*positions)
+        aligned = []
+        for array_positions, array_values in zip(positions, values):
+            array_aligned = np.zeros(len(union), dtype=array_values.dtype)
+            array_aligned[np.searchsorted(union, array_positions)] = array_values
+            aligned.append(array_aligned)
+        return union, aligned
+
+    @classmethod
+    def compare(cls, reference_file, test_file, atol=None, rtol=None):
+        import numpy as np
+
+        array_ref = cls.read(reference_file)
+        array_new = cls.read(test_file)
+
+        message = f"\n\na: {test_file}\nb: {reference_file}\n\n"
+        if array_ref.shape != array_new.shape:
+            return False, message + f"Shapes differ: {array_new.shape} != {array_ref.shape}\n"
+
+        positions, (values_ref, values_new) = cls._aligned(array_ref, array_new)
+        mismatch = np.flatnonzero(~np.isclose(values_ref, values_new, atol=atol, rtol=rtol, equal_nan=True))
+        if len(mismatch) == 0:
+            return True, ""
+
+        size = np.prod(array_ref.shape, dtype=float)
+        difference = np.abs(values_new[mismatch] - values_ref[mismatch])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            relative = difference / np.abs(values_new[mismatch])
+        first = mismatch[0]
+        message += f"Not equal to tolerance rtol={rtol:g}, atol={atol:g}\n\n"
+        message += (f"Mismatched elements: {len(mismatch)} / {size:.0f} ({100 * len(mismatch) / size:.3g}%), "
+                    f"out of {len(positions)} stored in either array\n")
+        message += (f"First mismatch at index {tuple(map(int, np.unravel_index(positions[first], array_ref.shape)))}: "
+                    f"{values_new[first]} (a) != {values_ref[first]} (b)\n")
+        message += f"Max absolute difference among violations: {difference.max():g}\n"
+        message += f"Max relative difference among violations: {relative.max():g}\n"
+        return False, message
+
+    @classmethod
+    def compare_data(cls, reference, data, atol=None, rtol=None, write_kwargs=None):
+        if not _is_sparse(data) or data.shape != reference.shape:
+            return False
+        _, (values_ref, values_new) = cls._aligned(reference, data)
+        return _allclose_blockwise(values_ref, values_new, atol=atol, rtol=rtol)
+
+
+# Quantiles compared by the summary format
+SUMMARY_QUANTILES = (0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99)
+
+
+class SummaryDiff(BaseDiff):
+    """
+    A compact statistical summary of an array of real numbers, stored as
+    JSON: its shape, moments, extrema and numbers of non-finite values, a
+    quantile sketch, and a seeded random sample of its elements. The size of
+    the reference does not depend on the size of the array.
+    """
+
+    extension = 'json'
+    compressible = True
+
+    @staticmethod
+    def read(filename):
+        with _open(filename, 'rt', _compression(filename)) as f:
+            return json.load(f)
+
+    @classmethod
+    def write(cls, filename, data, sample_size=1024, seed=0, relative_accuracy=0.01):
+        summary = cls.summarize(data, sample_size=sample_size, seed=seed, relative_accuracy=relative_accuracy)
+        with open(filename, 'w') as f:
+            json.dump(summary, f, indent=1)
+
+    @staticmethod
+    def _quantile(sketch, count, level):
+        # Estimate a quantile from the logarithmically-spaced buckets of the
+        # sketch, to within its relative accuracy (as in DDSketch)
+        gamma = (1 + sketch['relative_accuracy']) / (1 - sketch['relative_accuracy'])
+        rank = level * (count - 1)
+        cumulative = 0
+        for key in sorted(sketch['negative'], reverse=True):
+            cumulative += sketch['negative'][key]
+            if cumulative > rank:
+                return -2 * gamma ** key / (gamma + 1)
+        cumulative += sketch['zero']
+        if cumulative > rank:
+            return 0.
+        for key in sorted(sketch['positive']):
+            cumulative += sketch['positive'][key]
+            if cumulative > rank:
+                return 2 * gamma ** key / (gamma + 1)
+
+    @classmethod
+    def summarize(cls, data, sample_size=1024, seed=0, relative_accuracy=0.01, sample_indices=None):
+        """
+        Return the summary of ``data`` in a single pass over its elements, in
+        blocks of at most ``BLOCK_SIZE``. The sample is made of the elements
+        at the given flat ``sample_indices``, or otherwise of ``sample_size``
+        elements drawn at random with the given ``seed``.
+        """
+        import numpy as np
+        array = np.asanyarray(data)
+        if array.dtype != bool and array.dtype.kind not in 'iuf':
+            raise TypeError("The 'summary' format only supports arrays of real numbers")
+
+        log_gamma = np.log((1 + relative_accuracy) / (1 - relative_accuracy))
+        sketch = {'relative_accuracy': relative_accuracy, 'zero': 0, 'positive': {}, 'negative': {}}
+        count, mean, m2 = 0, 0., 0.
+        minimum, maximum = np.inf, -np.inf
+        nan = posinf = neginf = 0
+
+        blocks = np.nditer(array, flags=['external_loop', 'buffered', 'zerosize_ok'], op_dtypes=[np.float64],
+                           casting='unsafe', buffersize=BLOCK_SIZE, order='K')
+        with blocks:
+            for block in blocks:
+                finite = block[np.isfinite(block)]
+                if finite.size < block.size:
+                    nan += int(np.isnan(block).sum())
+                    posinf += int((block == np.inf).sum())
+                    neginf += int((block == -np.inf).sum())
+                if finite.size == 0:
+                    continue
+                # Combine the moments of the block with the running ones
+                block_mean = finite.mean()
+                block_m2 = ((finite - block_mean) ** 2).sum()
+                delta = block_mean - mean
+                total = count + finite.size
+                mean += delta * finite.size / total
+                m2 += block_m2 + delta ** 2 * count * finite.size / total
+                count = total
+                minimum = min(minimum, finite.min())
+                maximum = max(maximum, finite.max())
+                sketch['zero'] += int((finite == 0).sum())
+                for store, values in ((sketch['positive'], finite[finite > 0]), (sketch['negative'], -finite[finite < 0])):
+                    if values.size == 0:
+                        continue
+                    keys = np.ceil(np.log(values) / log_gamma).astype(np.int64)
+                    first = int(keys.min())
+                    counts = np.bincount(keys - first)
+                    for offset in np.flatnonzero(counts).tolist():
+                        store[first + offset] = store.get(first + offset, 0) + int(counts[offset])
+
+        if sample_indices is None:
+            rng = np.random.default_rng(seed)
+            sample_indices = np.sort(rng.choice(array.size, min(sample_size, array.size), replace=False))
+        sample = array.flat[np.asarray(sample_indices, dtype=np.intp)].astype(np.float64)
+
+        return {'shape': list(array.shape),
+                'count': count, 'nan': nan, 'posinf': posinf, 'neginf': neginf,
+                'min': float(minimum) if count else None,
+                'max': float(maximum) if count else None,
+                'mean': float(mean) if count else None,
+                'std': float(np.sqrt(m2 / count)) if count else None,
+                'quantiles': {str(level): cls._quantile(sketch, count, level) if count else None
+                              for level in SUMMARY_QUANTILES},
+                'sketch': dict(sketch, positive={str(key): value for key, value in sketch['positive'].items()},
+                               negative={str(key): value for key, value in sketch['negative'].items()}),
+                'sample': {'seed': seed, 'indices': [int(index) for index in sample_indices], 'values': sample.tolist()}}
+
+    @staticmethod
+    def _differences(reference, summary, atol=None, rtol=None):
+        """
+        Return a description of each statistic of ``summary`` that does not
+        match the ``reference`` summary to within the tolerances.
+        """
+        import numpy as np
+
+        if reference['shape'] != summary['shape']:
+            return [f"Shapes differ: {tuple(summary['shape'])} != {tuple(reference['shape'])}"]
+
+        def close(value_ref, value_new):
+            if value_ref is None or value_new is None:
+                return value_ref is value_new
+            return bool(np.isclose(value_ref, value_new, atol=atol, rtol=rtol, equal_nan=True))
+
+        # The extrema are not compared, as they are too noisy for outputs that
+        # are random rather than deterministic
+        differences = []
+        for name in ('count', 'nan', 'posinf', 'neginf', 'mean', 'std'):
+            if not close(reference[name], summary[name]):
+                differences.append(f"{name}: {summary[name]} (a) != {reference[name]} (b)")
+        for level, value_ref in reference['quantiles'].items():
+            if not close(value_ref, summary['quantiles'].get(level)):
+                differences.append(f"{level} quantile: {summary['quantiles'].get(level)} (a) != {value_ref} (b)")
+
+        if reference['sample']['indices'] != summary['sample']['indices']:
+            differences.append("The samples are of different elements")
+            return differences
+        values_ref = np.array(reference['sample']['values'], dtype=float)
+        values_new = np.array(summary['sample']['values'], dtype=float)
+        mismatch = np.flatnonzero(~np.isclose(values_ref, values_new, atol=atol, rtol=rtol, equal_nan=True))
+        if len(mismatch):
+            index = tuple(map(int, np.unravel_index(reference['sample']['indices'][mismatch[0]], reference['shape'])))
+            differences.append(f"{len(mismatch)} / {len(values_ref)} sampled elements differ, first at index {index}: "
+                               f"{values_new[mismatch[0]]} (a) != {values_ref[mismatch[0]]} (b)")
+        return differences
+
+    @classmethod
+    def compare(cls, reference_file, test_file, atol=None, rtol=None):
+        differences = cls._differences(cls.read(reference_file), cls.read(test_file), atol=atol, rtol=rtol)
+        if differences:
+            return False, (f"\n\na: {test_file}\nb: {reference_file}\n\n"
+                           f"Not equal to tolerance rtol={rtol:g}, atol={atol:g}\n\n" + '\n'.join(differences) + '\n')
+        else:
+            return True, ""
+
+    @classmethod
+    def compare_data(cls, reference, data, atol=None, rtol=None, write_kwargs=None):
+        import numpy as np
+        if list(np.shape(data)) != reference['shape']:
+            return False
+        # Summarize the test array like the reference, sampling the same elements
+        summary = cls.summarize(data, seed=reference['sample']['seed'],
+                                relative_accuracy=reference['sketch']['relative_accuracy'],
+                                sample_indices=reference['sample']['indices'])
+        return not cls._differences(reference, summary, atol=atol, rtol=rtol)
+
+
+def _is_sparse(data):
+    # Checked without importing scipy, which tests may not use
+    return type(data).__module__.startswith('scipy.sparse')
+
+
+FORMATS = {}
+FORMATS['fits'] = FITSDiff
+FORMATS['text'] = TextDiff
+FORMATS['npy'] = NPYDiff
+FORMATS['npz'] = NPZDiff
+FORMATS['pd_hdf'] = PDHDFDiff
+FORMATS['arrow'] = ArrowDiff
+FORMATS['sparse'] = SparseDiff
+FORMATS['summary'] = SummaryDiff
+
+
+# Size of the chunks in which downloaded files are streamed to disk
+DOWNLOAD_CHUNK_SIZE = 1024 ** 2
+
+
+def _download_file(url):
+    from urllib.request import urlopen
+    u = urlopen(url)
+    result_dir = tempfile.mkdtemp()
+    filename = os.path.join(result_dir, 'downloaded')
+    with open(filename, 'wb') as tmpfile:
+        shutil.copyfileobj(u, tmpfile, DOWNLOAD_CHUNK_SIZE)
+    return filename
+
+
+class DownloadCache:
+    """
+    Persistent, content-addressed cache of downloaded reference files.
+
+    Files are stored under ``objects/`` by the SHA-256 digest of their
+    content, and ``index.json`` maps each URL to its digest along with the
+    ``ETag`` and ``Last-Modified`` validators sent by the server, so that
+    cached files can be revalidated with conditional requests. When the cache
+    is closed, the least recently used files are removed until the total size
+    is under ``max_bytes``.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(directory, 'objects'), exist_ok=True)
+        self._index = self._load_index()
+        self._updated = set()
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.directory, 'index.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _object(self, digest):
+        return os.path.join(self.directory, 'objects', digest)
+
+    def validators(self, url):
+        """
+        Return the headers to use to revalidate the cached copy of ``url``,
+        or an empty dict if it is not cached.
+        """
+        with self._lock:
+            entry = self._index.get(url)
+        if entry is None or not os.path.exists(self._object(entry['digest'])):
+            return {}
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def touch(self, url):
+        """
+        Mark the cached copy of ``url`` as used and return its filename.
+        """
+        with self._lock:
+            entry = self._index[url]
+            entry['used'] = time.time()
+            self._updated.add(url)
+        return self._object(entry['digest'])
+
+    def store(self, url, response):
+        """
+        Stream the body of ``response`` (the reply to a request for ``url``)
+        into the cache and return the filename of the cached copy.
+        """
+        import hashlib
+        digest = hashlib.sha256()
+        fd, tmp_filename = tempfile.mkstemp(dir=self.directory, prefix='.download-')
+        try:
+            with os.fdopen(fd, 'wb') as tmpfile:
+                while True:
+                    chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    tmpfile.write(chunk)
+            size = os.path.getsize(tmp_filename)
+            os.replace(tmp_filename, self._object(digest.hexdigest()))
+        except BaseException:
+            os.remove(tmp_filename)
+            raise
+        with self._lock:
+            self._index[url] = {'digest': digest.hexdigest(),
+                                'size': size,
+                                'etag': response.getheader('ETag'),
+                                'last_modified': response.getheader('Last-Modified'),
+                                'used': time.time()}
+            self._updated.add(url)
+        return self._object(digest.hexdigest())
+
+    def close(self):
+        with self._lock:
+            # Other sessions may have used the cache concurrently, so merge
+            # our changes into the current index rather than overwriting it.
+            index = self._load_index()
+            index.update({url: self._index[url] for url in self._updated})
+            index = {url: entry for url, entry in index.items()
+                     if os.path.exists(self._object(entry['digest']))}
+
+            # Evict the least recently used files until under budget. Several
+            # URLs can share the same content, so sizes are counted per digest.
+            last_used = {}
+            for entry in index.values():
+                last_used[entry['digest']] = max(last_used.get(entry['digest'], 0), entry['used'])
+            sizes = {entry['digest']: entry['size'] for entry in index.values()}
+            total = sum(sizes.values())
+            for digest in sorted(last_used, key=last_used.get):
+                if total <= self.max_bytes:
+                    break
+                os.remove(self._object(digest))
+                total -= sizes[digest]
+            index = {url: entry for url, entry in index.items()
+                     if os.path.exists(self._object(entry['digest']))}
+
+            fd, tmp_filename = tempfile.mkstemp(dir=self.directory, prefix='.index-')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(index, f, indent=1, sort_keys=True)
+            os.replace(tmp_filename, os.path.join(self.directory, 'index.json'))
+            self._index = index
+            self._updated.clear()
+
+
+class RemoteReferences:
+    """
+    Download remote reference files concurrently.
+
+    Files are fetched by a bounded pool of worker threads, each of which keeps
+    a persistent HTTP connection per host, and are streamed to a temporary
+    directory shared by the whole session. Each URL is only downloaded once.
+
+    If a `DownloadCache` is given, files are instead stored in it and cached
+    copies are revalidated with conditional requests rather than downloaded
+    again.
+
+    Proxies are used as configured in the environment (``http_proxy``,
+    ``https_proxy`` and ``no_proxy``), as by ``urlopen``: HTTP requests are
+    sent to the proxy, and HTTPS connections are tunnelled through it.
+    """
+
+    max_redirects = 5
+
+    def __init__(self, max_workers=8, cache=None):
+        from concurrent.futures import ThreadPoolExecutor
+        from urllib.request import getproxies
+        self.cache = cache
+        self._proxies = getproxies()
+        self.directory = None
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='arraydiff-download')
+        self._futures = {}
+        self._connections = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def prefetch(self, url):
+        """
+        Start downloading ``url`` in the background, if not already started,
+        and return the corresponding future.
+        """
+        with self._lock:
+            if url not in self._futures:
+                if self.directory is None:
+                    self.directory = tempfile.mkdtemp(prefix='arraydiff-')
+                self._futures[url] = self._executor.submit(self._download, url)
+            return self._futures[url]
+
+    def get(self, url):
+        """
+        Return the local filename for ``url``, waiting for the download to
+        complete if needed.
+        """
+        return self.prefetch(url).result()
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        for connection in self._connections:
+            connection.close()
+        if self.cache is not None:
+            self.cache.close()
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _proxy(self, scheme, netloc):
+        """
+        Return the URL of the proxy through which to connect to ``netloc``,
+        or `None` to connect directly.
+        """
+        from urllib.request import proxy_bypass
+        proxy = self._proxies.get(scheme)
+        if proxy is None or proxy_bypass(netloc):
+            return None
+        return proxy if '://' in proxy else 'http://' + proxy
+
+    def _connection(self, scheme, netloc):
+        """
+        Return the connection of this thread to ``netloc``, and the headers to
+        add to requests sent to a proxy for forwarding (`None` if requests are
+        sent directly or through a tunnel).
+        """
+        import base64
+        import http.client
+        from urllib.parse import unquote
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        if (scheme, netloc) not in connections:
+            proxy = self._proxy(scheme, netloc)
+            if proxy is None:
+                connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+                connection = connection_class(netloc)
+                forward_headers = None
+            else:
+                proxy = urlsplit(proxy)
+                proxy_headers = {}
+                if proxy.username is not None:
+                    credentials = f"{unquote(proxy.username)}:{unquote(proxy.password or '')}"
+                    proxy_headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials.encode()).decode()
+                if scheme == 'https':
+                    connection = http.client.HTTPSConnection(proxy.hostname, proxy.port or 80)
+                    connection.set_tunnel(netloc, headers=proxy_headers)
+                    forward_headers = None
+                else:
+                    connection = http.client.HTTPConnection(proxy.hostname, proxy.port or 80)
+                    forward_headers = proxy_headers
+            connections[scheme, netloc] = connection, forward_headers
+            with self._lock:
+                self._connections.append(connection)
+        return connections[scheme, netloc]
+
+    def _request(self, url, headers):
+        import http.client
+        parts = urlsplit(url)
+        connection, forward_headers = self._connection(parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        if forward_headers is not None:
+            # Proxies are sent the full URL
+            path = f"{parts.scheme}://{parts.netloc}{path}"
+            headers = dict(headers, **forward_headers)
+        try:
+            connection.request('GET', path, headers=headers)
+            return connection.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionError):
+            # The server closed an idle keep-alive connection; retry once on
+            # a new connection.
+            connection.close()
+            connection.request('GET', path, headers=headers)
+            return connection.getresponse()
+
+    def _download(self, url):
+        import hashlib
+        from urllib.error import HTTPError
+        original_url = url
+        headers = {} if self.cache is None else self.cache.validators(url)
+        filename = os.path.join(self.directory, hashlib.sha256(url.encode()).hexdigest()[:16]
+                                + '-' + os.path.basename(urlsplit(url).path))
+        for _ in range(self.max_redirects + 1):
+            response = self._request(url, headers)
+            if response.status in (301, 302, 303, 307, 308):
+                response.read()
+                url = urljoin(url, response.getheader('Location'))
+                continue
+            if response.status == 304 and headers:
+                response.read()
+                return self.cache.touch(original_url)
+            if response.status != 200:
+                response.read()
+                raise HTTPError(url, response.status, response.reason, response.headers, None)
+            if self.cache is not None:
+                return self.cache.store(original_url, response)
+            with open(filename, 'wb') as tmpfile:
+                shutil.copyfileobj(response, tmpfile, DOWNLOAD_CHUNK_SIZE)
+            return filename
+        raise HTTPError(url, response.status, 'Too many redirects', response.headers, None)
+
+
+MEMORY_CACHE_MAX_ENTRIES = 128
+
+
+class ReferenceCache:
+    """
+    Session-wide cache of parsed reference files.
+
+    References are keyed by absolute path, size and modification time, so a
+    file that changes on disk is parsed again. The total size of the cached
+    references in memory (see ``_resident_nbytes``) is kept under
+    ``max_bytes``, and their number under ``max_entries`` (since memory-mapped
+    references each keep a file open), by evicting the least recently used
+    ones. `CompressedNPY` references hold no decompressed data, so they are
+    not cached.
+    """
+
+    def __init__(self, max_bytes, max_entries=MEMORY_CACHE_MAX_ENTRIES):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, filename, reader):
+        """
+        Return the parsed reference for ``filename``, calling ``reader`` on it
+        if it is not already cached.
+        """
+        stat = os.stat(filename)
+        key = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+
+        reference = reader(filename)
+        if isinstance(reference, CompressedNPY):
+            return reference
+        nbytes = _resident_nbytes(reference)
+
+        if nbytes <= self.max_bytes:
+            with self._lock:
+                if key not in self._entries:
+                    self._entries[key] = reference, nbytes
+                    self._size += nbytes
+                while self._size > self.max_bytes or len(self._entries) > self.max_entries:
+                    _, (_, size) = self._entries.popitem(last=False)
+                    self._size -= size
+                    self.evictions += 1
+
+        return reference
+
+    def summary(self):
+        return (f"arraydiff reference cache: {self.hits} hits, {self.misses} misses, "
+                f"{self.evictions} evictions")
+
+
+def _array_digest(array, block_size=BLOCK_SIZE):
+    """
+    Return a SHA-256 digest of the dtype, shape and bytes of ``array``, or
+    `None` if ``array`` is not a plain Numpy array of a fixed-size dtype.
+
+    The data are hashed in C order and little-endian byte order, so that the
+    digest does not depend on the memory layout of the array.
+    """
+    import hashlib
+    import numpy as np
+    if type(array) is not np.ndarray or array.dtype.hasobject:
+        return None
+    dtype = array.dtype.newbyteorder('<') if array.dtype.byteorder == '>' else array.dtype
+    digest = hashlib.sha256(f"{dtype.str}{array.shape}".encode())
+    blocks = np.nditer(array, flags=['external_loop', 'buffered', 'zerosize_ok'],
+                       op_dtypes=[dtype], buffersize=block_size, order='C')
+    with blocks:
+        for block in blocks:
+            digest.update(np.ascontiguousarray(block))
+    return digest.hexdigest()
+
+
+class ReferenceManifest:
+    """
+    Digests of the arrays from which reference files were generated.
+
+    Each reference directory can hold a ``arraydiff-manifest.json`` file
+    mapping reference filenames to the digest (see ``_array_digest``), dtype
+    and shape of the array that was written, along with the size of the
+    file. A test whose result has the same digest is known to match the
+    reference without reading it, as long as the file has the same size.
+    Modification times are not recorded, since they change whenever the
+    references are checked out or packaged.
+
+    Unless ``write`` is true, generating references does not add entries
+    but drops those of the files that are rewritten.
+    """
+
+    filename = 'arraydiff-manifest.json'
+
+    def __init__(self, write=True):
+        self.write = write
+        self._manifests = {}
+        self._updated = set()
+        self._lock = threading.Lock()
+
+    def _load(self, directory):
+        if directory not in self._manifests:
+            try:
+                with open(os.path.join(directory, self.filename)) as f:
+                    self._manifests[directory] = json.load(f)
+            except (OSError, ValueError):
+                self._manifests[directory] = {}
+        return self._manifests[directory]
+
+    def matches(self, reference_file, array):
+        """
+        Return whether ``array`` is identical to the array from which
+        ``reference_file`` was generated, according to the manifest.
+        """
+        directory, name = os.path.split(os.path.abspath(reference_file))
+        with self._lock:
+            entry = self._load(directory).get(name)
+        if entry is None or entry['size'] != os.path.getsize(reference_file):
+            return False
+        return _array_digest(array) == entry['sha256']
+
+    def record(self, reference_file, array):
+        """
+        Record the digest of ``array``, from which ``reference_file`` was
+        just written.
+        """
+        digest = _array_digest(array)
+        if digest is None:
+            return
+        directory, name = os.path.split(os.path.abspath(reference_file))
+        entry = {'sha256': digest, 'dtype': array.dtype.str, 'shape': list(array.shape),
+                 'size': os.path.getsize(reference_file)}
+        with self._lock:
+            self._load(directory)[name] = entry
+            self._updated.add(directory)
+
+    def written(self, reference_file, array):
+        """
+        Record the digest of ``array`` after ``reference_file`` was generated
+        from it if the manifest is written, and otherwise drop any entry for
+        the file, which no longer describes it.
+        """
+        if self.write:
+            self.record(reference_file, array)
+            return
+        directory, name = os.path.split(os.path.abspath(reference_file))
+        with self._lock:
+            if self._load(directory).pop(name, None) is not None:
+                self._updated.add(directory)
+
+    def update(self, reference_file, array):
+        """
+        Replace the entry for ``reference_file``, if it has one, after the file
+        was rewritten from ``array``.
+        """
+        directory, name = os.path.split(os.path.abspath(reference_file))
+        with self._lock:
+            if name not in self._load(directory):
+                return
+            del self._manifests[directory][name]
+            self._updated.add(directory)
+        self.record(reference_file, array)
+
+    def save(self):
+        with self._lock:
+            for directory in self._updated:
+                filename = os.path.join(directory, self.filename)
+                with open(filename, 'w') as f:
+                    json.dump(self._manifests[directory], f, indent=1, sort_keys=True)
+            self._updated.clear()
+
+
+# Number of measurements in progress, for which tracemalloc is tracing
+_tracing = 0
+_tracing_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _measure_performance():
+    """
+    Measure the wall time and the peak memory traced by tracemalloc while
+    the body of the ``with`` statement runs, which are stored in the yielded
+    dict as ``time`` (in seconds) and ``peak_memory`` (in bytes) at the end.
+
+    Tracing is only started for the duration of the measurements, unless it
+    was already on. Measurements running at the same time in several threads
+    share the peak memory.
+    """
+    import tracemalloc
+    global _tracing
+    with _tracing_lock:
+        if _tracing == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracing = 1
+        elif _tracing > 0:
+            _tracing += 1
+        tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+    performance = {}
+    start = time.perf_counter()
+    try:
+        yield performance
+    finally:
+        performance['time'] = time.perf_counter() - start
+        with _tracing_lock:
+            performance['peak_memory'] = max(tracemalloc.get_traced_memory()[1] - start_memory, 0)
+            if _tracing > 0:
+                _tracing -= 1
+                if _tracing == 0:
+                    tracemalloc.stop()
+
+
+# Times and memory below which regressions are ignored, as too noisy
+PERFORMANCE_MIN_TIME = 0.01
+PERFORMANCE_MIN_MEMORY = 1024 ** 2
+
+
+class PerformanceRecords:
+    """
+    Wall time and peak memory of the tests that produced the reference files.
+
+    Each reference directory can hold a ``arraydiff-performance.json`` file
+    mapping reference filenames (without any compression suffix) to the
+    ``time`` (in seconds) and ``peak_memory`` (in bytes) measured by
+    ``_measure_performance`` when the reference was generated.
+    """
+
+    filename = 'arraydiff-performance.json'
+
+    def __init__(self):
+        self._records = {}
+        self._updated = set()
+        self._lock = threading.Lock()
+
+    def _load(self, directory):
+        if directory not in self._records:
+            try:
+                with open(os.path.join(directory, self.filename)) as f:
+                    self._records[directory] = json.load(f)
+            except (OSError, ValueError):
+                self._records[directory] = {}
+        return self._records[directory]
+
+    def get(self, reference_file):
+        """
+        Return the performance recorded for ``reference_file``, or `None`.
+        """
+        directory, name = os.path.split(os.path.abspath(reference_file))
+        with self._lock:
+            return self._load(directory).get(name)
+
+    def record(self, reference_file, performance):
+        """
+        Record the ``performance`` (as measured by ``_measure_performance``)
+        of the test that produced ``reference_file``.
+        """
+        directory, name = os.path.split(os.path.abspath(reference_file))
+        with self._lock:
+            self._load(directory)[name] = {'time': performance['time'],
+                                           'peak_memory': performance['peak_memory']}
+            self._updated.add(directory)
+
+    @staticmethod
+    def regressions(record, performance, tolerance):
+        """
+        Return descriptions of the measures of ``performance`` that exceed
+        ``tolerance`` times the ``record``.
+        """
+        regressions = []
+        if performance['time'] > tolerance * max(record['time'], PERFORMANCE_MIN_TIME):
+            regressions.append(f"wall time {performance['time']:.3g} s, "
+                               f"recorded {record['time']:.3g} s")
+        if performance['peak_memory'] > tolerance * max(record['peak_memory'], PERFORMANCE_MIN_MEMORY):
+            regressions.append(f"peak memory {performance['peak_memory'] / 1024 ** 2:.3g} MB, "
+                               f"recorded {record['peak_memory'] / 1024 ** 2:.3g} MB")
+        return regressions
+
+    def save(self):
+        with self._lock:
+            for directory in self._updated:
+                os.makedirs(directory, exist_ok=True)
+                filename = os.path.join(directory, self.filename)
+                with open(filename, 'w') as f:
+                    json.dump(self._records[directory], f, indent=1, sort_keys=True)
+            self._updated.clear()
+
+
+class ReferenceArchive:
+    """
+    Reference arrays packed into a single file per directory.
+
+    In generate mode, plain Numpy arrays can be written to an
+    ``arraydiff-references.pack`` file instead of one file each. The archive
+    starts with an 8-byte magic string and the offset of the index, followed by
+    the raw C-order data of each array (aligned to 64 bytes) and by the index,
+    a JSON object mapping reference filenames to the offset, dtype and shape
+    of the array. When comparing, each archive is memory-mapped once for the
+    session and references are returned as views into it.
+
+    Unless ``write`` is true, generating references does not add arrays to
+    archives but drops the entries of the files that are written separately,
+    which would otherwise take precedence over them.
+    """
+
+    filename = 'arraydiff-references.pack'
+    magic = b'ADPACK01'
+    alignment = 64
+
+    def __init__(self, write=True):
+        self.write = write
+        self._archives = {}
+        self._writers = {}
+        self._removed = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def accepts(data):
+        """
+        Return whether ``data`` can be stored in an archive.
+        """
+        import numpy as np
+        return type(data) is np.ndarray and not data.dtype.hasobject and data.dtype.fields is None
+
+    def _load(self, directory):
+        import mmap
+        if directory not in self._archives:
+            path = os.path.join(directory, self.filename)
+            try:
+                with open(path, 'rb') as f:
+                    buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (FileNotFoundError, ValueError):
+                # No archive, or an empty file (which cannot be mapped)
+                self._archives[directory] = None
+            else:
+                if buffer[:len(self.magic)] != self.magic:
+                    buffer.close()
+                    raise ValueError(f"{path} is not an arraydiff reference archive")
+                index_offset, = struct.unpack('<Q', buffer[len(self.magic):len(self.magic) + 8])
+                self._archives[directory] = buffer, json.loads(buffer[index_offset:].decode())
+        return self._archives[directory]
+
+    def get(self, directory, name):
+        """
+        Return the reference array stored as ``name`` in the archive in
+        ``directory``, or `None` if there is no such archive or entry.
+        """
+        import numpy as np
+        with self._lock:
+            archive = self._load(directory)
+        if archive is None or name not in archive[1]:
+            return None
+        buffer, index = archive
+        entry = index[name]
+        shape = tuple(entry['shape'])
+        return np.frombuffer(buffer, dtype=entry['dtype'], count=int(np.prod(shape)),
+                             offset=entry['offset']).reshape(shape)
+
+    def _append(self, f, data):
+        # Write ``data`` at the end of ``f``, aligned, and return its offset
+        end = f.seek(0, os.SEEK_END)
+        f.write(b'\0' * (-end % self.alignment))
+        offset = f.tell()
+        f.write(data)
+        return offset
+
+    def add(self, directory, name, array):
+        """
+        Store ``array`` as ``name`` in the archive for ``directory``. The
+        archive is only written out by ``save``.
+        """
+        import numpy as np
+        # Note that ascontiguousarray turns 0-d arrays into 1-d ones
+        data = np.ascontiguousarray(array)
+        with self._lock:
+            self._removed.get(directory, set()).discard(name)
+            _, f, index = self._writer(directory)
+            offset = self._append(f, data.data if data.size else b'')
+            index[name] = {'offset': offset, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+
+    def remove(self, directory, name):
+        """
+        Drop any entry for ``name`` from the archive for ``directory``, when
+        the archive is written out by ``save``.
+        """
+        with self._lock:
+            self._removed.setdefault(directory, set()).add(name)
+            if directory in self._writers:
+                self._writers[directory][2].pop(name, None)
+
+    def _writer(self, directory):
+        # The temporary file to which the archive for ``directory`` is
+        # written, the open file and the index of the arrays added so far
+        if directory not in self._writers:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix='.arraydiff-pack-')
+            f = os.fdopen(fd, 'w+b')
+            f.write(self.magic + struct.pack('<Q', 0))
+            self._writers[directory] = tmp_filename, f, {}
+        return self._writers[directory]
+
+    def save(self):
+        """
+        Write out the archives to which arrays were added or from which
+        entries were removed. Entries of an existing archive in the same
+        directory that were neither replaced nor removed are carried over, and
+        archives left empty are deleted.
+        """
+        import numpy as np
+        with self._lock:
+            for directory, removed in self._removed.items():
+                if directory in self._writers or not removed:
+                    continue
+                self._archives.pop(directory, None)
+                existing = self._load(directory)
+                if existing is not None:
+                    existing[0].close()
+                    if removed & set(existing[1]):
+                        self._writer(directory)
+                del self._archives[directory]
+            for directory, (tmp_filename, f, index) in self._writers.items():
+                removed = self._removed.get(directory, set())
+                try:
+                    # Always merge with the archive currently on disk
+                    self._archives.pop(directory, None)
+                    existing = self._load(directory)
+                    if existing is not None:
+                        buffer, existing_index = existing
+                        with memoryview(buffer) as view:
+                            for name, entry in existing_index.items():
+                                if name not in index and name not in removed:
+                                    nbytes = int(np.prod(entry['shape'])) * np.dtype(entry['dtype']).itemsize
+                                    offset = self._append(f, view[entry['offset']:entry['offset'] + nbytes])
+                                    index[name] = dict(entry, offset=offset)
+                        buffer.close()
+                    del self._archives[directory]
+                    filename = os.path.join(directory, self.filename)
+                    if not index:
+                        if os.path.exists(filename):
+                            os.remove(filename)
+                        continue
+                    f.seek(0, os.SEEK_END)
+                    index_offset = f.tell()
+                    f.write(json.dumps(index, sort_keys=True).encode())
+                    f.seek(len(self.magic))
+                    f.write(struct.pack('<Q', index_offset))
+                    f.close()
+                    os.replace(tmp_filename, filename)
+                finally:
+                    f.close()
+                    if os.path.exists(tmp_filename):
+                        os.remove(tmp_filename)
+            self._writers.clear()
+            self._removed.clear()
+
+    def close(self):
+        with self._lock:
+            for archive in self._archives.values():
+                if archive is not None:
+                    try:
+                        archive[0].close()
+                    except BufferError:
+                        # Some references are still in use
+                        pass
+            self._archives.clear()
+
+
+def _nbytes(data):
+    """
+    Return the approximate size in memory of a data object returned by a test.
+    """
+    import numpy as np
+    if isinstance(data, np.ndarray):
+        return data.nbytes
+    if hasattr(data, 'memory_usage'):
+        # pandas DataFrame
+        return int(data.memory_usage(deep=True).sum())
+    if hasattr(data, 'data') and isinstance(data.data, np.ndarray):
+        # FITS HDU
+        return data.data.nbytes
+    if isinstance(data, dict):
+        # Named arrays for a container format
+        return sum(_nbytes(element) for element in data.values())
+    if isinstance(data, (list, tuple)):
+        # FITS HDUList
+        return sum(_nbytes(element) for element in data)
+    return 0
+
+
+def _resident_nbytes(reference):
+    """
+    Return the approximate size in memory of a parsed reference, leaving out
+    the data memory-mapped from the reference file (which the operating
+    system pages in and out).
+    """
+    import mmap
+    import numpy as np
+    if isinstance(reference, np.ndarray):
+        base = reference
+        while base is not None:
+            if isinstance(base, (np.memmap, mmap.mmap)):
+                return 0
+            base = getattr(base, 'base', None)
+        return reference.nbytes
+    if hasattr(reference, 'data') and isinstance(reference.data, np.ndarray):
+        # FITS HDU
+        return _resident_nbytes(reference.data)
+    if isinstance(reference, dict):
+        return sum(_resident_nbytes(element) for element in reference.values())
+    if isinstance(reference, (list, tuple)):
+        return sum(_resident_nbytes(element) for element in reference)
+    return _nbytes(reference)
+
+
+class CaptureMonitor:
+    """
+    Keep track of the total size of the data returned by tests that is still
+    in memory, and of its peak over the session.
+
+    Data are tracked with weak references until they are garbage-collected,
+    so anything kept alive by a background comparison or write is counted.
+    Objects that do not support weak references are not tracked.
+    """
+
+    def __init__(self):
+        self.resident = 0
+        self.peak = 0
+        self.peak_nodeid = None
+        self._lock = threading.Lock()
+
+    def capture(self, nodeid, data):
+        nbytes = _nbytes(data)
+        if nbytes == 0:
+            return
+        try:
+            weakref.finalize(data, self._release, nbytes)
+        except TypeError:
+            return
+        with self._lock:
+            self.resident += nbytes
+            if self.resident > self.peak:
+                self.peak = self.resident
+                self.peak_nodeid = nodeid
+
+    def _release(self, nbytes):
+        with self._lock:
+            self.resident -= nbytes
+
+    def summary(self):
+        return (f"arraydiff captured arrays: peak of {self.peak / 1024 ** 2:.1f} MB "
+                f"resident (while running {self.peak_nodeid})")
+
+
+class BoundedExecutor:
+    """
+    A pool of background threads, on which the total size of the data held
+    by the tasks that have not completed yet is kept under ``max_bytes``:
+    ``submit`` blocks until enough earlier tasks have completed (data larger
+    than ``max_bytes`` are accepted once nothing else is in flight).
+    """
+
+    def __init__(self, max_workers, max_bytes, thread_name_prefix):
+        from concurrent.futures import ThreadPoolExecutor
+        self.max_bytes = max_bytes
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix=thread_name_prefix)
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    def submit(self, nbytes, function, *args, **kwargs):
+        """
+        Run ``function`` on the pool once ``nbytes`` more bytes fit under the
+        limit, and return its future.
         """
-        raise NotImplementedError()
+        with self._condition:
+            self._condition.wait_for(lambda: self._in_flight == 0
+                                     or self._in_flight + nbytes <= self.max_bytes)
+            self._in_flight += nbytes
+        future = self._executor.submit(function, *args, **kwargs)
+        future.add_done_callback(lambda future: self._release(nbytes))
+        return future
 
-    @abstractstaticmethod
-    def write(filename, data, **kwargs):
+    def _release(self, nbytes):
+        with self._condition:
+            self._in_flight -= nbytes
+            self._condition.notify_all()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+class ComparisonQueue:
+    """
+    Run comparisons on a pool of background threads, so that they overlap
+    with the execution of the following tests.
+
+    The total size of the data waiting to be compared is kept under
+    ``max_bytes`` (see `BoundedExecutor`).
+    """
+
+    def __init__(self, max_workers, max_bytes):
+        self._executor = BoundedExecutor(max_workers, max_bytes, 'arraydiff-compare')
+        self._pending = []
+
+    def submit(self, item, nbytes, function, *args, **kwargs):
+        self._pending.append((item, self._executor.submit(nbytes, function, *args, **kwargs)))
+
+    def pop_completed(self, wait_all=False):
         """
-        Given a filename and a data object (and optional keyword arguments),
-        write the data to a file.
+        Return the ``(item, future)`` pairs of the comparisons that have
+        completed, waiting for all of them if ``wait_all`` is set.
         """
-        raise NotImplementedError()
+        from concurrent.futures import wait
+        if wait_all:
+            wait([future for _, future in self._pending])
+        # Check each future only once, since a comparison that completes
+        # between two checks would otherwise end up in neither list
+        completed, pending = [], []
+        for item, future in self._pending:
+            (completed if future.done() else pending).append((item, future))
+        self._pending = pending
+        return completed
+
+    def close(self):
+        self._executor.shutdown()
+
+
+def _write(file_format, filename, data, write_kwargs):
+    """
+    Write ``data`` to ``filename`` in the given format, compressed if the
+    format is compressible and ``filename`` ends with one of the suffixes in
+    ``COMPRESSIONS``.
 
-    @abstractclassmethod
-    def compare(self, reference_file, test_file, atol=None, rtol=None):
-        """
-        Given a reference and test filename, compare the data to the specified
-        absolute (``atol``) and relative (``rtol``) tolerances.
+    Since not all writers can write to a stream, compressed files are first
+    written uncompressed next to ``filename`` and then compressed in chunks.
+    Iterators over blocks of rows are written one block at a time.
+    """
+    if isinstance(data, Iterator):
+        write = FORMATS[file_format].write_blocks
+    else:
+        write = FORMATS[file_format].write
+    uncompressed, compression = _split_compression(filename)
+    if compression is None or not FORMATS[file_format].compressible:
+        write(filename, data, **write_kwargs)
+        return
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(filename)), prefix='.arraydiff-')
+    try:
+        tmp_filename = os.path.join(tmp_dir, os.path.basename(uncompressed))
+        write(tmp_filename, data, **write_kwargs)
+        with open(tmp_filename, 'rb') as fin, _open(filename, 'wb', compression) as fout:
+            shutil.copyfileobj(fin, fout, DOWNLOAD_CHUNK_SIZE)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _write_atomic(file_format, filename, data, write_kwargs):
+    """
+    Write ``data`` to ``filename`` in the given format (see ``_write``), so
+    that the file only appears once it has been fully written.
 
-        Should return two arguments: a boolean indicating whether the data are
-        identical, and a string giving the full error message if not.
-        """
-        raise NotImplementedError()
+    The file is written to a temporary directory next to ``filename`` (with
+    the same basename, since some writers derive metadata from it) and then
+    renamed into place, replacing any existing file.
+    """
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(filename), prefix='.arraydiff-')
+    try:
+        tmp_filename = os.path.join(tmp_dir, os.path.basename(filename))
+        _write(file_format, tmp_filename, data, write_kwargs)
+        os.replace(tmp_filename, filename)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
 
 
-class SimpleArrayDiff(BaseDiff):
+class ReferenceUpdates:
+    """
+    Reference files rewritten with ``--arraydiff-update`` because they were
+    missing or no longer matched the results of their tests.
+    """
 
-    @classmethod
-    def compare(cls, reference_file, test_file, atol=None, rtol=None):
+    def __init__(self):
+        self.files = []
+        self._lock = threading.Lock()
 
-        array_ref = cls.read(reference_file)
-        array_new = cls.read(test_file)
+    def record(self, filename, created=False):
+        with self._lock:
+            self.files.append((filename, created))
 
-        try:
-            np.testing.assert_allclose(array_ref, array_new, atol=atol, rtol=rtol)
-        except AssertionError as exc:
-            message = f"\n\na: {test_file}" + '\n'
-            message += f"b: {reference_file}" + '\n'
-            message += exc.args[0]
-            return False, message
-        else:
-            return True, ""
+    def summary(self, terminalreporter):
+        terminalreporter.write_sep('=', f'arraydiff: updated {len(self.files)} reference files')
+        for filename, created in sorted(self.files):
+            terminalreporter.write_line(f"{filename} (new)" if created else filename)
 
 
-class FITSDiff(BaseDiff):
+class ReferenceWriter:
+    """
+    Write reference files in generate mode on a pool of background threads.
 
-    extension = 'fits'
+    Files are written atomically (see ``_write_atomic``). Errors are
+    collected rather than raised, and are available in ``errors`` once
+    ``flush`` has been called.
 
-    @staticmethod
-    def read(filename):
-        from astropy.io import fits
-        return fits.getdata(filename)
+    The total size of the data waiting to be written is kept under
+    ``max_bytes`` (see `BoundedExecutor`).
+    """
+
+    def __init__(self, max_workers=4, max_bytes=1024 ** 3):
+        self._executor = BoundedExecutor(max_workers, max_bytes, 'arraydiff-write')
+        self._futures = []
+        self._directories = set()
+        self._lock = threading.Lock()
+        self.errors = []
+
+    def submit(self, file_format, filename, data, write_kwargs, callback=None):
+        """
+        Queue ``data`` to be written to ``filename``; ``callback`` is then
+        called with the filename and data once the file is in place.
+        """
+        directory = os.path.dirname(filename)
+        with self._lock:
+            if directory not in self._directories:
+                os.makedirs(directory, exist_ok=True)
+                self._directories.add(directory)
+        future = self._executor.submit(_nbytes(data), self._write, file_format, filename, data, write_kwargs, callback)
+        self._futures.append((filename, future))
 
     @staticmethod
-    def write(filename, data, **kwargs):
-        from astropy.io import fits
-        if isinstance(data, np.ndarray):
-            data = fits.PrimaryHDU(data)
-        return data.writeto(filename, **kwargs)
+    def _write(file_format, filename, data, write_kwargs, callback):
+        _write_atomic(file_format, filename, data, write_kwargs)
+        if callback is not None:
+            callback(filename, data)
 
-    @classmethod
-    def compare(cls, reference_file, test_file, atol=None, rtol=None):
-        import astropy
-        from astropy.io.fits.diff import FITSDiff
-        from astropy.utils.introspection import minversion
-        if minversion(astropy, '2.0'):
-            diff = FITSDiff(reference_file, test_file, rtol=rtol, atol=atol)
-        else:
-            # `atol` is not supported prior to Astropy 2.0
-            diff = FITSDiff(reference_file, test_file, tolerance=rtol)
-        return diff.identical, diff.report()
+    def flush(self):
+        """
+        Wait for all queued files to be written, and collect the errors.
+        """
+        from concurrent.futures import wait
+        wait([future for _, future in self._futures])
+        for filename, future in self._futures:
+            if future.exception() is not None:
+                self.errors.append((filename, future.exception()))
+        self._futures = []
 
+    def close(self):
+        self.flush()
+        self._executor.shutdown()
 
-class TextDiff(SimpleArrayDiff):
 
-    extension = 'txt'
+class Profile:
+    """
+    Time spent and bytes moved in each phase of the comparison for one test.
 
-    @staticmethod
-    def read(filename):
-        return np.loadtxt(filename)
+    The phases are ``test`` (running the test itself, for the marker API),
+    ``fetch`` (downloading remote references), ``read`` (reading the
+    reference), ``compare``, and, if the comparison fails or in generate mode,
+    ``serialize`` (writing the test array), ``copy`` (copying the reference
+    next to it) and ``cleanup``.
+    """
 
-    @staticmethod
-    def write(filename, data, **kwargs):
-        fmt = kwargs.get('fmt', '%g')
-        kwargs['fmt'] = fmt
-        return np.savetxt(filename, data, **kwargs)
+    def __init__(self, nodeid):
+        self.nodeid = nodeid
+        self.seconds = {}
+        self.bytes = {}
+        # Several invocations of a test can be compared concurrently
+        self._lock = threading.Lock()
 
+    @contextlib.contextmanager
+    def phase(self, name, nbytes=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+            self.add_bytes(name, nbytes)
 
-class PDHDFDiff(BaseDiff):
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.seconds[name] = self.seconds.get(name, 0.) + seconds
 
-    extension = 'h5'
+    def add_bytes(self, name, nbytes):
+        with self._lock:
+            self.bytes[name] = self.bytes.get(name, 0) + nbytes
 
-    @staticmethod
-    def read(filename):
-        import pandas as pd
-        return pd.read_hdf(filename)
+    @property
+    def total(self):
+        return sum(self.seconds.values())
 
-    @staticmethod
-    def write(filename, data, **kwargs):
-        import pandas as pd  # noqa: F401
-        key = os.path.basename(filename).replace('.h5', '')
-        return data.to_hdf(filename, key=key, **kwargs)
+    def to_dict(self):
+        return {'nodeid': self.nodeid,
+                'total': self.total,
+                'phases': {name: {'seconds': self.seconds[name], 'bytes': self.bytes.get(name, 0)}
+                           for name in self.seconds}}
 
-    @classmethod
-    def compare(cls, reference_file, test_file, atol=None, rtol=None):
-        import pandas.testing as pdt
-        import pandas as pd
 
-        ref_data = pd.read_hdf(reference_file)
-        test_data = pd.read_hdf(test_file)
-        try:
-            pdt.assert_frame_equal(ref_data, test_data)
-        except AssertionError as exc:
-            message = f"\n\na: {test_file}" + '\n'
-            message += f"b: {reference_file}" + '\n'
-            message += exc.args[0]
-            return False, message
-        else:
-            return True, ""
+class Profiler:
+    """
+    Collect the `Profile` of each test and summarize them.
+    """
 
+    def __init__(self, json_file=None):
+        self.json_file = json_file
+        self.profiles = []
+        self._lock = threading.Lock()
 
-FORMATS = {}
-FORMATS['fits'] = FITSDiff
-FORMATS['text'] = TextDiff
-FORMATS['pd_hdf'] = PDHDFDiff
+    def add(self, profile):
+        with self._lock:
+            self.profiles.append(profile)
 
+    def write_json(self):
+        with open(self.json_file, 'w') as f:
+            json.dump([profile.to_dict() for profile in self.profiles], f, indent=1)
 
-def _download_file(url):
-    u = urlopen(url)
-    result_dir = tempfile.mkdtemp()
-    filename = os.path.join(result_dir, 'downloaded')
-    with open(filename, 'wb') as tmpfile:
-        tmpfile.write(u.read())
-    return filename
+    def summary(self, terminalreporter, slowest=10):
+        terminalreporter.write_sep('=', 'arraydiff profile')
+
+        seconds = {}
+        nbytes = {}
+        for profile in self.profiles:
+            for name, value in profile.seconds.items():
+                seconds[name] = seconds.get(name, 0.) + value
+                nbytes[name] = nbytes.get(name, 0) + profile.bytes.get(name, 0)
+        terminalreporter.write_line(f"{'phase':<12}{'seconds':>12}{'MB':>12}")
+        for name in sorted(seconds, key=seconds.get, reverse=True):
+            terminalreporter.write_line(f"{name:<12}{seconds[name]:>12.3f}{nbytes[name] / 1024 ** 2:>12.1f}")
+
+        terminalreporter.write_line('')
+        terminalreporter.write_line(f"slowest {slowest} tests:")
+        for profile in sorted(self.profiles, key=lambda profile: profile.total, reverse=True)[:slowest]:
+            phases = ', '.join(f"{name} {value:.3f}s" for name, value in
+                               sorted(profile.seconds.items(), key=lambda phase: phase[1], reverse=True))
+            terminalreporter.write_line(f"{profile.total:.3f}s {profile.nodeid} ({phases})")
 
 
 def pytest_addoption(parser):
@@ -189,23 +2405,71 @@ def pytest_addoption(parser):
                     help="Enable comparison of arrays to reference arrays stored in files")
     group.addoption('--arraydiff-generate-path',
                     help="directory to generate reference files in, relative to location where py.test is run", action='store')
+    group.addoption('--arraydiff-update', action='store_true',
+                    help="Compare arrays to reference arrays, and rewrite in place the reference files that "
+                         "are missing or differ")
     group.addoption('--arraydiff-reference-path',
                     help="directory containing reference files, relative to location where py.test is run", action='store')
+    group.addoption('--arraydiff-manifest', action='store_true',
+                    help="When generating reference files, also write a manifest of the digests of the "
+                         "arrays, used to skip reading references for identical results")
+    group.addoption('--arraydiff-async', action='store_true',
+                    help="Compare arrays returned by tests in background threads, while the next tests run")
+    group.addoption('--arraydiff-async-workers', type=int, default=4,
+                    help="Number of threads used to compare arrays with --arraydiff-async (default 4)")
+    group.addoption('--arraydiff-async-memory', type=float, default=1024,
+                    help="Maximum size in MB of the arrays waiting to be compared with --arraydiff-async (default 1024)")
+    group.addoption('--arraydiff-write-workers', type=int, default=4,
+                    help="Number of threads used to write reference files in generate mode (default 4)")
+    group.addoption('--arraydiff-write-memory', type=float, default=1024,
+                    help="Maximum size in MB of the arrays waiting to be written in generate mode (default 1024)")
+    group.addoption('--arraydiff-profile', action='store_true',
+                    help="Show the time spent and bytes moved in each phase of the array comparisons")
+    group.addoption('--arraydiff-profile-json',
+                    help="File to write the time spent and bytes moved in each phase of the array comparisons to, as JSON")
+    group.addoption('--arraydiff-pack', action='store_true',
+                    help="Write plain reference arrays to a single arraydiff-references.pack archive "
+                         "per directory when generating reference files")
+    group.addoption('--arraydiff-memory-report', action='store_true',
+                    help="Show the peak size of the arrays returned by tests that were in memory at the same time")
     group.addoption('--arraydiff-default-format',
-                    help="Default format for the reference arrays (can be 'fits' or 'text' currently)")
+                    help="Default format for the reference arrays (can be 'fits', 'text' or 'npy' currently)")
+    group.addoption('--arraydiff-compression', choices=sorted(COMPRESSIONS),
+                    help="Compression of the reference files written for the 'text', 'fits', 'npy' and "
+                         "'summary' formats (compressed references are always read)")
+    group.addoption('--arraydiff-memory-cache', type=float, default=256,
+                    help="Size in MB of the session-wide cache of parsed reference files "
+                         "(0 disables the cache, default 256)")
+    group.addoption('--arraydiff-download-workers', type=int, default=8,
+                    help="Number of threads used to download remote reference files (default 8)")
+    group.addoption('--arraydiff-cache-dir',
+                    help="Directory in which to cache downloaded reference files across sessions")
+    group.addoption('--arraydiff-cache-size', type=float, default=1024,
+                    help="Maximum size in MB of the cache of downloaded reference files (default 1024)")
+    group.addoption('--arraydiff-perf-tolerance', type=float,
+                    help="Record the wall time and peak memory of marked tests when generating reference files, "
+                         "and fail tests that exceed them by more than this factor when comparing (can be set "
+                         "per test with perf_tolerance)")
+    group.addoption('--arraydiff-perf-warn', action='store_true',
+                    help="Only warn, rather than fail, when tests exceed their recorded performance")
 
 
 def pytest_configure(config):
     config.getini('markers').append(
         'array_compare: for functions using array comparison')
 
-    if config.getoption("--arraydiff") or config.getoption("--arraydiff-generate-path") is not None:
+    if (config.getoption("--arraydiff") or config.getoption("--arraydiff-update")
+            or config.getoption("--arraydiff-generate-path") is not None):
 
         reference_dir = config.getoption("--arraydiff-reference-path")
         generate_dir = config.getoption("--arraydiff-generate-path")
+        update = config.getoption("--arraydiff-update")
 
         if reference_dir is not None and generate_dir is not None:
             warnings.warn("Ignoring --arraydiff-reference-path since --arraydiff-generate-path is set")
+        if update and generate_dir is not None:
+            warnings.warn("Ignoring --arraydiff-update since --arraydiff-generate-path is set")
+            update = False
 
         if reference_dir is not None:
             reference_dir = os.path.abspath(reference_dir)
@@ -213,11 +2477,63 @@ def pytest_configure(config):
             reference_dir = os.path.abspath(generate_dir)
 
         default_format = config.getoption("--arraydiff-default-format") or 'text'
+        default_compression = config.getoption("--arraydiff-compression")
+
+        memory_cache = config.getoption("--arraydiff-memory-cache")
+        download_workers = config.getoption("--arraydiff-download-workers")
+
+        cache_dir = config.getoption("--arraydiff-cache-dir")
+        if cache_dir is not None:
+            cache_dir = os.path.abspath(cache_dir)
+        cache_size = config.getoption("--arraydiff-cache-size")
+
+        manifest = config.getoption("--arraydiff-manifest")
+        pack = config.getoption("--arraydiff-pack")
+
+        if config.getoption("--arraydiff-async") and generate_dir is None:
+            comparison_queue = ComparisonQueue(config.getoption("--arraydiff-async-workers"),
+                                               int(config.getoption("--arraydiff-async-memory") * 1024 ** 2))
+        else:
+            comparison_queue = None
+
+        if generate_dir is not None:
+            reference_writer = ReferenceWriter(config.getoption("--arraydiff-write-workers"),
+                                               int(config.getoption("--arraydiff-write-memory") * 1024 ** 2))
+        else:
+            reference_writer = None
+
+        profile_json = config.getoption("--arraydiff-profile-json")
+        if config.getoption("--arraydiff-profile") or profile_json is not None:
+            profiler = Profiler(json_file=profile_json and os.path.abspath(profile_json))
+        else:
+            profiler = None
+
+        if config.getoption("--arraydiff-memory-report"):
+            capture_monitor = CaptureMonitor()
+        else:
+            capture_monitor = None
+
+        perf_tolerance = config.getoption("--arraydiff-perf-tolerance")
+        perf_warn = config.getoption("--arraydiff-perf-warn")
 
         config.pluginmanager.register(ArrayComparison(config,
                                                       reference_dir=reference_dir,
                                                       generate_dir=generate_dir,
-                                                      default_format=default_format),
+                                                      default_format=default_format,
+                                                      default_compression=default_compression,
+                                                      memory_cache=memory_cache,
+                                                      download_workers=download_workers,
+                                                      cache_dir=cache_dir,
+                                                      cache_size=cache_size,
+                                                      manifest=manifest,
+                                                      pack=pack,
+                                                      update=update,
+                                                      comparison_queue=comparison_queue,
+                                                      reference_writer=reference_writer,
+                                                      profiler=profiler,
+                                                      capture_monitor=capture_monitor,
+                                                      perf_tolerance=perf_tolerance,
+                                                      perf_warn=perf_warn),
                                       name='arraydiff')
     else:
         config.pluginmanager.register(ArrayInterceptor(config))
@@ -234,33 +2550,30 @@ def generate_test_name(item):
     return name
 
 
-def _compare_array(array, item, options, *, plugin_reference_dir,
-                   generate_dir, default_format):
+def _reference_compression(options, file_format, default_compression=None):
     """
-    Compare ``array`` against the reference for ``item``, or, in generate mode,
-    write it out.
-
-    ``options`` is a mapping accepting the same keys as the ``array_compare``
-    marker and the ``array_compare`` fixture's ``check`` method (``file_format``,
-    ``extension``, ``atol``, ``rtol``, ``single_reference``, ``write_kwargs``,
-    ``reference_dir``, ``filename``).  This is the shared core used both by the
-    marker-based API (which captures the test's return value) and the
-    fixture-based API (where the test passes the array in explicitly).
+    Return the compression of the reference file given the ``array_compare``
+    ``options``, which can set it with a ``compression`` key in their
+    ``write_kwargs``, and the ``--arraydiff-compression`` option.
     """
-    file_format = options.get('file_format', default_format)
+    if not FORMATS[file_format].compressible:
+        return None
+    compression = options.get('write_kwargs', {}).get('compression', default_compression)
+    if compression is not None and compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression: {compression}")
+    return compression
 
-    if file_format not in FORMATS:
-        raise ValueError(f"Unknown format: {file_format}")
 
+def _reference_location(item, options, file_format, *, plugin_reference_dir, compression=None):
+    """
+    Return the reference directory (a local path or a URL) and the reference
+    filename for ``item``, given the ``array_compare`` ``options`` and the
+    ``compression`` of the file (see ``_reference_compression``).
+    """
     extension = options.get('extension', FORMATS[file_format].extension)
 
-    atol = options.get('atol', 0.)
-    rtol = options.get('rtol', 1e-7)
-
     single_reference = options.get('single_reference', False)
 
-    write_kwargs = options.get('write_kwargs', {})
-
     reference_dir = options.get('reference_dir', None)
     if reference_dir is None:
         if plugin_reference_dir is None:
@@ -271,8 +2584,6 @@ def _compare_array(array, item, options, *, plugin_reference_dir,
         if not reference_dir.startswith(('http://', 'https://')):
             reference_dir = os.path.join(os.path.dirname(item.fspath.strpath), reference_dir)
 
-    baseline_remote = reference_dir.startswith('http')
-
     # Find test name to use as the reference filename
     filename = options.get('filename', None)
     if filename is None:
@@ -283,47 +2594,277 @@ def _compare_array(array, item, options, *, plugin_reference_dir,
             filename = filename.replace('[', '_').replace(']', '_')
             filename = filename.replace('_.' + extension, '.' + extension)
 
+    if compression is not None and _split_compression(filename)[1] is None:
+        filename += '.' + compression
+
+    return reference_dir, filename
+
+
+def _file_format(array, options, default_format):
+    """
+    Return the format in which ``array`` is stored given the ``array_compare``
+    ``options``, which depends on the type of ``array`` if no format is given.
+    """
+    file_format = options.get('file_format', default_format)
+
+    if file_format not in FORMATS:
+        raise ValueError(f"Unknown format: {file_format}")
+
+    # Dicts of named arrays are stored in a single container file
+    if isinstance(array, dict) and not FORMATS[file_format].container:
+        if 'file_format' in options:
+            raise ValueError(f"The '{file_format}' format cannot store several arrays, use 'npz', 'fits' or 'arrow'")
+        file_format = 'npz'
+
+    # Sparse arrays are stored as such rather than densified
+    if _is_sparse(array) and 'file_format' not in options:
+        file_format = 'sparse'
+
+    return file_format
+
+
+def _compare_array(array, item, options, *, plugin_reference_dir,
+                   generate_dir, default_format, default_compression=None, reference_cache=None,
+                   remote_references=None, manifest=None, reference_writer=None,
+                   archive=None, reference_updates=None, profile=None):
+    """
+    Compare ``array`` against the reference for ``item``, or, in generate mode,
+    write it out.
+
+    ``options`` is a mapping accepting the same keys as the ``array_compare``
+    marker and the ``array_compare`` fixture's ``check`` method (``file_format``,
+    ``extension``, ``atol``, ``rtol``, ``single_reference``, ``write_kwargs``,
+    ``reference_dir``, ``filename``).  This is the shared core used both by the
+    marker-based API (which captures the test's return value) and the
+    fixture-based API (where the test passes the array in explicitly).
+
+    Parsed references are looked up in ``reference_cache`` (a
+    `ReferenceCache`) and remote references are fetched through
+    ``remote_references`` (a `RemoteReferences`) when these are given. If a
+    ``manifest`` (a `ReferenceManifest`) is given, it is used to skip reading
+    local references for results that are bit-identical to the array the
+    reference was generated from, and, in generate mode, it is updated with
+    the new references. In generate mode, files are written in the background
+    by ``reference_writer`` (a `ReferenceWriter`) if given. If an ``archive``
+    (a `ReferenceArchive`) is given, local references are looked up in it
+    before looking for separate files, and, in generate mode, plain arrays are
+    added to it rather than written out. If ``reference_updates`` (a
+    `ReferenceUpdates`) is given, local references that are missing or differ
+    are rewritten in place from ``array`` and recorded there instead of raising
+    an exception. The time spent and bytes moved in each phase are recorded in
+    ``profile`` (a `Profile`) if given.
+
+    ``array`` can also be a lazy output (see ``_blocks``), which is then
+    compared and written one block of rows at a time for the formats that
+    support it (see ``BaseDiff.streamable``).
+    """
+    file_format = _file_format(array, options, default_format)
+
+    # Lazy outputs are passed around as iterators over their blocks of rows,
+    # so that they are never held in memory in full. Chunked arrays are only
+    # read in blocks if the format allows it.
+    blocks = _blocks(array)
+    if blocks is not None:
+        if FORMATS[file_format].streamable:
+            array = blocks
+        elif isinstance(array, Iterator):
+            raise ValueError(f"The '{file_format}' format cannot store outputs given as blocks of rows, use 'text' or 'npy'")
+        else:
+            blocks = None
+
+    atol = options.get('atol', 0.)
+    rtol = options.get('rtol', 1e-7)
+
+    if (isinstance(atol, dict) or isinstance(rtol, dict)) and not FORMATS[file_format].container:
+        raise ValueError("Tolerances can only be given by array name for the 'npz', 'fits' and 'arrow' formats")
+
+    # Compression is applied to whole files rather than by the writers
+    compression = _reference_compression(options, file_format, default_compression)
+    write_kwargs = options.get('write_kwargs', {})
+    if FORMATS[file_format].compressible:
+        write_kwargs = {key: value for key, value in write_kwargs.items() if key != 'compression'}
+
+    reference_dir, filename = _reference_location(item, options, file_format,
+                                                  plugin_reference_dir=plugin_reference_dir,
+                                                  compression=compression)
+
+    baseline_remote = reference_dir.startswith('http')
+
+    if profile is None:
+        profile = Profile(None)
+
     # What we do now depends on whether we are generating the reference
     # files or simply running the test.
     if generate_dir is None:
 
-        # Save the array
-        result_dir = tempfile.mkdtemp()
-        test_array = os.path.abspath(os.path.join(result_dir, filename))
-
-        FORMATS[file_format].write(test_array, array, **write_kwargs)
-
         # Find path to baseline array
         if baseline_remote:
-            baseline_file_ref = _download_file(reference_dir + filename)
+            with profile.phase('fetch'):
+                if remote_references is None:
+                    baseline_file_ref = _download_file(reference_dir + filename)
+                else:
+                    baseline_file_ref = remote_references.get(reference_dir + filename)
+                profile.add_bytes('fetch', os.path.getsize(baseline_file_ref))
         else:
             baseline_file_ref = os.path.abspath(os.path.join(os.path.dirname(item.fspath.strpath), reference_dir, filename))
-
-        if not os.path.exists(baseline_file_ref):
+        expected_file_ref = baseline_file_ref
+
+        # References in an archive are views into a memory-mapped file, so
+        # need neither the manifest nor the reference cache. They are never
+        # compressed, and are looked up before any file is checked for.
+        reference = None
+        if archive is not None and not baseline_remote:
+            with profile.phase('read'):
+                reference = archive.get(*os.path.split(_split_compression(baseline_file_ref)[0]))
+            if reference is not None:
+                profile.add_bytes('read', reference.nbytes)
+        packed = reference is not None
+
+        # Local references are found whether they are compressed or not
+        if (not packed and not baseline_remote and FORMATS[file_format].compressible
+                and not os.path.exists(baseline_file_ref)):
+            uncompressed = _split_compression(baseline_file_ref)[0]
+            for candidate in [uncompressed] + [f"{uncompressed}.{suffix}" for suffix in COMPRESSIONS]:
+                if os.path.exists(candidate):
+                    baseline_file_ref = candidate
+                    break
+
+        if not packed and not os.path.exists(baseline_file_ref):
+            if reference_updates is not None and not baseline_remote:
+                with profile.phase('serialize', _nbytes(array)):
+                    os.makedirs(os.path.dirname(baseline_file_ref), exist_ok=True)
+                    _write_atomic(file_format, baseline_file_ref, array, write_kwargs)
+                reference_updates.record(baseline_file_ref, created=True)
+                return
+            result_dir = tempfile.mkdtemp()
+            test_array = os.path.abspath(os.path.join(result_dir, filename))
+            _write(file_format, test_array, array, write_kwargs)
             raise Exception("""File not found for comparison test
                             Generated file:
                             \t{test}
                             This is expected for new tests.""".format(
                 test=test_array))
 
+        # Blocks can only be read once, so to be able to update the reference
+        # they are first written out and read back (memory-mapped for .npy)
+        if blocks is not None and reference_updates is not None and not baseline_remote:
+            with profile.phase('serialize'):
+                blocks_dir = tempfile.mkdtemp()
+                blocks_file = os.path.join(blocks_dir, os.path.basename(_split_compression(filename)[0]))
+                _write(file_format, blocks_file, array, write_kwargs)
+                array = FORMATS[file_format].read(blocks_file)
+                weakref.finalize(array, shutil.rmtree, blocks_dir, True)
+            blocks = None
+
+        with profile.phase('compare'):
+            if (not packed and manifest is not None and not baseline_remote
+                    and manifest.matches(baseline_file_ref, array)):
+                return
+
+        def read_reference(filename):
+            profile.add_bytes('read', os.path.getsize(filename))
+            return FORMATS[file_format].read_reference(filename)
+
+        # Compare in memory first: the reference is read once and the test
+        # array is only written out if it does not match.
+        if not packed:
+            with profile.phase('read'):
+                if reference_cache is None:
+                    reference = read_reference(baseline_file_ref)
+                else:
+                    reference = reference_cache.get(baseline_file_ref, read_reference)
+        with profile.phase('compare', _nbytes(array)):
+            if blocks is not None:
+                identical, msg = FORMATS[file_format].compare_blocks(reference, array, atol=atol, rtol=rtol,
+                                                                     write_kwargs=write_kwargs)
+                if not identical:
+                    # There is nothing left of the output to save for the report
+                    raise Exception("\n\nThe output, given as blocks of rows, differs from the reference\n"
+                                    f"b: {baseline_file_ref}\n" + msg)
+                return
+            elif packed:
+                identical = _allclose_blockwise(reference, FORMATS[file_format].roundtrip(array, **write_kwargs),
+                                                atol=atol, rtol=rtol)
+            else:
+                identical = FORMATS[file_format].compare_data(reference, array, atol=atol, rtol=rtol,
+                                                              write_kwargs=write_kwargs)
+        if identical:
+            return
+        if not packed:
+            del reference
+
+        # Save the array
+        with profile.phase('serialize'):
+            result_dir = tempfile.mkdtemp()
+            test_array = os.path.abspath(os.path.join(result_dir, filename))
+
+            _write(file_format, test_array, array, write_kwargs)
+            profile.add_bytes('serialize', os.path.getsize(test_array))
+
         # setuptools may put the baseline arrays in non-accessible places,
         # copy to our tmpdir to be sure to keep them in case of failure
         baseline_file = os.path.abspath(os.path.join(result_dir, 'reference-' + filename))
-        shutil.copyfile(baseline_file_ref, baseline_file)
+        if packed:
+            with profile.phase('copy', reference.nbytes):
+                _write(file_format, baseline_file, reference, write_kwargs)
+            del reference
+        else:
+            with profile.phase('copy', os.path.getsize(baseline_file_ref)):
+                shutil.copyfile(baseline_file_ref, baseline_file)
 
-        identical, msg = FORMATS[file_format].compare(baseline_file, test_array, atol=atol, rtol=rtol)
+        with profile.phase('compare'):
+            identical, msg = FORMATS[file_format].compare(baseline_file, test_array, atol=atol, rtol=rtol)
 
         if identical:
-            shutil.rmtree(result_dir)
+            with profile.phase('cleanup'):
+                shutil.rmtree(result_dir)
+        elif reference_updates is not None and not baseline_remote:
+            # The file written for the report becomes the new reference. It is
+            # moved next to the reference first so that the replacement is
+            # atomic even if the temporary directory is on another device. The
+            # new reference is compressed as configured, which can change its
+            # name.
+            with profile.phase('copy', os.path.getsize(test_array)):
+                if packed:
+                    archive.add(*os.path.split(_split_compression(baseline_file_ref)[0]),
+                                FORMATS[file_format].roundtrip(array, **write_kwargs))
+                else:
+                    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(expected_file_ref), prefix='.arraydiff-')
+                    os.close(fd)
+                    shutil.move(test_array, tmp_filename)
+                    os.replace(tmp_filename, expected_file_ref)
+                    if baseline_file_ref != expected_file_ref:
+                        os.remove(baseline_file_ref)
+                    if manifest is not None:
+                        manifest.update(expected_file_ref, array)
+                shutil.rmtree(result_dir)
+            reference_updates.record(baseline_file_ref if packed else expected_file_ref)
         else:
             raise Exception(msg)
 
     else:
 
-        if not os.path.exists(generate_dir):
-            os.makedirs(generate_dir)
-
-        FORMATS[file_format].write(os.path.abspath(os.path.join(generate_dir, filename)), array, **write_kwargs)
+        reference_file = os.path.abspath(os.path.join(generate_dir, filename))
+
+        callback = None if manifest is None else manifest.written
+
+        with profile.phase('serialize', _nbytes(array)):
+            if archive is not None and archive.write and FORMATS[file_format].packable and archive.accepts(array):
+                archive.add(*os.path.split(_split_compression(reference_file)[0]),
+                            FORMATS[file_format].roundtrip(array, **write_kwargs))
+            else:
+                if archive is not None:
+                    # An archive entry would take precedence over the file
+                    archive.remove(*os.path.split(_split_compression(reference_file)[0]))
+                # Lazy outputs may depend on the fixtures of the test, so
+                # are written before it is torn down
+                if reference_writer is None or _blocks(array) is not None:
+                    os.makedirs(generate_dir, exist_ok=True)
+                    _write_atomic(file_format, reference_file, array, write_kwargs)
+                    if callback is not None:
+                        callback(reference_file, array)
+                else:
+                    reference_writer.submit(file_format, reference_file, array, write_kwargs, callback=callback)
 
         pytest.skip("Skipping test, since generating data")
 
@@ -331,6 +2872,10 @@ def _compare_array(array, item, options, *, plugin_reference_dir,
 def wrap_array_interceptor(plugin, item):
     """
     Intercept and store arrays returned by test functions.
+
+    The array returned by each invocation of the test function is passed to
+    ``plugin.capture``, so that none are lost when the function is called
+    several times, possibly concurrently (e.g. by pytest-run-parallel).
     """
     # Only intercept array on marked array tests
     if item.get_closest_marker('array_compare') is not None:
@@ -343,9 +2888,22 @@ def wrap_array_interceptor(plugin, item):
         # Use the full test name as a key to ensure correct array is being retrieved
         test_name = generate_test_name(item)
 
+        # Tests with a performance tolerance are timed and their allocations
+        # traced, which is not free, so the others are left alone
+        try:
+            measure = plugin.perf_tolerance_for(item.get_closest_marker('array_compare').kwargs) is not None
+        except ValueError:
+            # Reported when the test runs
+            measure = True
+
         def array_interceptor(store, obj):
             def wrapper(*args, **kwargs):
-                store.return_value[test_name] = obj(*args, **kwargs)
+                if not measure:
+                    store.capture(test_name, obj(*args, **kwargs))
+                    return
+                with _measure_performance() as performance:
+                    array = obj(*args, **kwargs)
+                store.capture(test_name, array, performance)
             wrapper._arraydiff_wrapped = True
             return wrapper
 
@@ -354,17 +2912,93 @@ def wrap_array_interceptor(plugin, item):
 
 class ArrayComparison:
 
-    def __init__(self, config, reference_dir=None, generate_dir=None, default_format='text'):
+    def __init__(self, config, reference_dir=None, generate_dir=None, default_format='text',
+                 default_compression=None, memory_cache=256, download_workers=8, cache_dir=None, cache_size=1024,
+                 manifest=False, pack=False, update=False, comparison_queue=None, reference_writer=None, profiler=None,
+                 capture_monitor=None, perf_tolerance=None, perf_warn=False):
         self.config = config
         self.reference_dir = reference_dir
         self.generate_dir = generate_dir
         self.default_format = default_format
+        self.default_compression = default_compression
+        # Arrays returned by each invocation of a marked test, by test name,
+        # and the performance of the invocations for tests with a perf_tolerance
         self.return_value = {}
+        self.performance = {}
+        self._return_value_lock = threading.Lock()
+        if memory_cache and generate_dir is None:
+            self.reference_cache = ReferenceCache(int(memory_cache * 1024 ** 2))
+        else:
+            self.reference_cache = None
+        if cache_dir is None:
+            download_cache = None
+        else:
+            download_cache = DownloadCache(cache_dir, int(cache_size * 1024 ** 2))
+        self.remote_references = RemoteReferences(max_workers=download_workers, cache=download_cache)
+        # Manifests are always used when comparing, but only written on
+        # request; otherwise generating only drops the entries it makes stale
+        self.manifest = ReferenceManifest(write=generate_dir is None or manifest)
+        # Archives are always read when comparing, but only written on
+        # request; otherwise generating only drops the entries it shadows
+        self.archive = ReferenceArchive(write=generate_dir is None or pack)
+        if update and generate_dir is None:
+            self.reference_updates = ReferenceUpdates()
+        else:
+            self.reference_updates = None
+        self.comparison_queue = comparison_queue
+        self.reference_writer = reference_writer
+        self.profiler = profiler
+        self.capture_monitor = capture_monitor
+        self.perf_tolerance = perf_tolerance
+        self.perf_warn = perf_warn
+        self.performance_records = PerformanceRecords()
 
     def pytest_collection_modifyitems(self, items):
         for item in items:
             wrap_array_interceptor(self, item)
 
+    def pytest_collection_finish(self, session):
+        # Start downloading remote references for the tests that will run, so
+        # that the tests do not have to wait for them. This is done here rather
+        # than in pytest_collection_modifyitems so that deselected tests are
+        # not included.
+        if self.generate_dir is not None:
+            return
+        for item in session.items:
+            compare = item.get_closest_marker('array_compare')
+            if compare is None:
+                continue
+            file_format = compare.kwargs.get('file_format', self.default_format)
+            if file_format not in FORMATS:
+                continue
+            try:
+                compression = _reference_compression(compare.kwargs, file_format, self.default_compression)
+            except ValueError:
+                # Reported when the test runs
+                continue
+            reference_dir, filename = _reference_location(item, compare.kwargs, file_format,
+                                                          plugin_reference_dir=self.reference_dir,
+                                                          compression=compression)
+            if reference_dir.startswith(('http://', 'https://')):
+                self.remote_references.prefetch(reference_dir + filename)
+
+    def pytest_sessionfinish(self, session):
+        if self.comparison_queue is not None:
+            self.comparison_queue.close()
+        self.remote_references.close()
+        if self.reference_writer is not None:
+            self.reference_writer.close()
+            if self.reference_writer.errors:
+                session.exitstatus = pytest.ExitCode.TESTS_FAILED
+        if self.manifest is not None:
+            self.manifest.save()
+        self.performance_records.save()
+        if self.archive is not None:
+            self.archive.save()
+            self.archive.close()
+        if self.profiler is not None and self.profiler.json_file is not None:
+            self.profiler.write_json()
+
     @pytest.hookimpl(hookwrapper=True)
     def pytest_runtest_call(self, item):
 
@@ -374,33 +3008,232 @@ class ArrayComparison:
             yield
             return
 
-        yield
+        start = time.perf_counter()
 
-        test_name = generate_test_name(item)
-        if test_name not in self.return_value:
+        outcome = yield
+
+        if self.profiler is None:
+            profile = None
+        else:
+            profile = Profile(item.nodeid)
+            profile.add_time('test', time.perf_counter() - start)
+
+        # Remove the arrays from the store so that they are released as soon
+        # as the comparison (or the writing of the reference) has finished.
+        with self._return_value_lock:
+            arrays = self.return_value.pop(generate_test_name(item), None)
+            performance = self.performance.pop(generate_test_name(item), None)
+        if not arrays or outcome.excinfo is not None:
             # Test function did not complete successfully
             return
-        array = self.return_value[test_name]
+        if self.capture_monitor is not None:
+            for array in arrays:
+                self.capture_monitor.capture(item.nodeid, array)
+
+        # Lazy outputs may depend on the fixtures of the test, so are compared
+        # before it is torn down
+        if self.comparison_queue is None or any(_blocks(array) is not None for array in arrays):
+            self.compare_invocations(item, arrays, compare.kwargs, profile=profile, performance=performance)
+        else:
+            self.comparison_queue.submit(item, sum(_nbytes(array) for array in arrays),
+                                         self.compare_invocations, item, arrays, compare.kwargs,
+                                         profile=profile, performance=performance)
+
+    def capture(self, test_name, array, performance=None):
+        """
+        Store the array returned by one invocation of a marked test, and its
+        ``performance`` (see ``_measure_performance``) if it was measured.
+        """
+        with self._return_value_lock:
+            self.return_value.setdefault(test_name, []).append(array)
+            if performance is not None:
+                self.performance.setdefault(test_name, []).append(performance)
+
+    def compare(self, item, array, options, profile=None):
+        """
+        Compare ``array`` to the reference for ``item`` (or write it out in
+        generate mode) with the given ``array_compare`` options.
+        """
+        self.compare_invocations(item, [array], options, profile=profile)
 
-        _compare_array(array, item, compare.kwargs,
+    def compare_invocations(self, item, arrays, options, profile=None, performance=None):
+        """
+        Compare the arrays returned by each invocation of ``item`` to its
+        reference, concurrently if there are several, and raise an exception
+        for the first that differs. Invocations are numbered in the order in
+        which they returned. In generate mode, the reference is written from
+        the first invocation, and with ``--arraydiff-update`` it is rewritten
+        from the first invocation if needed before the others are compared.
+
+        If the ``performance`` of the invocations was measured, the best one
+        is recorded in generate mode, and otherwise checked once the arrays
+        have been compared (see ``_check_performance``).
+        """
+        if self.profiler is not None and profile is None:
+            profile = Profile(item.nodeid)
+        try:
+            if self.generate_dir is not None:
+                if performance:
+                    self._check_performance(item, arrays[0], options, performance)
+                self._compare_array(item, arrays[0], options, profile)
+                return
+            if len(arrays) == 1:
+                self._compare_array(item, arrays[0], options, profile)
+                if performance:
+                    self._check_performance(item, arrays[0], options, performance)
+                return
+            first = 0
+            if self.reference_updates is not None:
+                self._compare_array(item, arrays[0], options, profile)
+                first = 1
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=min(len(arrays), os.cpu_count() or 1),
+                                    thread_name_prefix='arraydiff-invocation') as executor:
+                futures = [executor.submit(self._compare_array, item, array, options, profile, update=False)
+                           for array in arrays[first:]]
+            failures = [(first + index, future.exception()) for index, future in enumerate(futures)
+                        if future.exception() is not None]
+            if failures:
+                index, exc = failures[0]
+                raise Exception(f"{len(failures)} of {len(arrays)} invocations of the test differ "
+                                f"from the reference, including invocation {index}:\n{exc}")
+            if performance:
+                self._check_performance(item, arrays[0], options, performance)
+        finally:
+            if self.profiler is not None:
+                self.profiler.add(profile)
+
+    def perf_tolerance_for(self, options):
+        """
+        Return the performance tolerance given the ``array_compare`` options,
+        or `None` if the performance of the test is not tracked.
+        """
+        tolerance = options.get('perf_tolerance', self.perf_tolerance)
+        if tolerance is not None and not tolerance > 0:
+            raise ValueError(f"perf_tolerance should be a positive factor, got {tolerance}")
+        return tolerance
+
+    def _check_performance(self, item, array, options, performance):
+        """
+        Record the best of the measured ``performance`` of the invocations of
+        ``item`` in generate mode (or with ``--arraydiff-update`` if none was
+        recorded), or fail (or warn, with ``--arraydiff-perf-warn``) if it
+        exceeds the recorded one by more than the tolerance. Remote references
+        have no recorded performance.
+        """
+        tolerance = self.perf_tolerance_for(options)
+        best = {key: min(measure[key] for measure in performance) for key in ('time', 'peak_memory')}
+        reference_dir, filename = _reference_location(item, options, _file_format(array, options, self.default_format),
+                                                      plugin_reference_dir=self.reference_dir)
+        filename = _split_compression(filename)[0]
+        if self.generate_dir is not None:
+            self.performance_records.record(os.path.join(self.generate_dir, filename), best)
+            return
+        if reference_dir.startswith('http'):
+            return
+        reference_file = os.path.join(os.path.dirname(item.fspath.strpath), reference_dir, filename)
+        record = self.performance_records.get(reference_file)
+        if record is None:
+            if self.reference_updates is not None:
+                self.performance_records.record(reference_file, best)
+            return
+        regressions = PerformanceRecords.regressions(record, best, tolerance)
+        if regressions:
+            message = (f"Performance regression past perf_tolerance={tolerance} "
+                       f"for {filename}: " + '; '.join(regressions))
+            if self.perf_warn:
+                warnings.warn(message)
+            else:
+                raise Exception(message)
+
+    def _compare_array(self, item, array, options, profile, update=True):
+        _compare_array(array, item, options,
                        plugin_reference_dir=self.reference_dir,
                        generate_dir=self.generate_dir,
-                       default_format=self.default_format)
+                       default_format=self.default_format,
+                       default_compression=self.default_compression,
+                       reference_cache=self.reference_cache,
+                       remote_references=self.remote_references,
+                       manifest=self.manifest,
+                       reference_writer=self.reference_writer,
+                       archive=self.archive,
+                       reference_updates=self.reference_updates if update else None,
+                       profile=profile)
+
+    def _report_comparisons(self, wait_all=False):
+        # Comparisons run in the background complete after the test has been
+        # reported, so failures are reported as errors at teardown.
+        from _pytest.reports import TestReport  # pytest.TestReport requires pytest>=7
+
+        for item, future in self.comparison_queue.pop_completed(wait_all=wait_all):
+            exc = future.exception()
+            if exc is None:
+                continue
+            report = TestReport(item.nodeid, item.location, {keyword: 1 for keyword in item.keywords},
+                                'failed', f"{type(exc).__name__}: {exc}", 'teardown',
+                                user_properties=item.user_properties)
+            item.ihook.pytest_runtest_logreport(report=report)
+
+    def pytest_runtest_logfinish(self, nodeid, location):
+        if self.comparison_queue is not None:
+            self._report_comparisons()
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtestloop(self, session):
+        yield
+        # Report the outstanding comparisons before the exit status is
+        # determined from the number of failures.
+        if self.comparison_queue is not None:
+            self._report_comparisons(wait_all=True)
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if self.profiler is not None and self.config.getoption("--arraydiff-profile"):
+            self.profiler.summary(terminalreporter)
+        if self.reference_writer is not None and self.reference_writer.errors:
+            terminalreporter.write_sep('=', 'arraydiff: errors writing reference files', red=True)
+            for filename, exc in self.reference_writer.errors:
+                terminalreporter.write_line(f"{filename}: {type(exc).__name__}: {exc}")
+        if self.reference_cache is not None and self.reference_cache.hits + self.reference_cache.misses > 0:
+            terminalreporter.write_line(self.reference_cache.summary())
+        if self.capture_monitor is not None:
+            terminalreporter.write_line(self.capture_monitor.summary())
+        if self.reference_updates is not None and self.reference_updates.files:
+            self.reference_updates.summary(terminalreporter)
+
+
+def _drain(data):
+    # Lazy outputs are still produced, as they would be for the comparison,
+    # so that running the tests without --arraydiff runs all of their code
+    if isinstance(data, Iterator):
+        for _ in data:
+            pass
+
+
+def _discard_return_value(function):
+    def wrapper(*args, **kwargs):
+        _drain(function(*args, **kwargs))
+    wrapper._arraydiff_wrapped = True
+    return wrapper
 
 
 class ArrayInterceptor:
     """
     This is used in place of ArrayComparison when the array comparison option is not used,
-    to make sure that we still intercept arrays returned by tests.
+    to make sure that arrays returned by tests are discarded rather than reported by pytest.
+
+    Marked tests are only wrapped as they are run, and their return values are not kept,
+    so that a disabled plugin does no work at collection time and holds on to no arrays.
     """
 
     def __init__(self, config):
         self.config = config
-        self.return_value = {}
 
-    def pytest_collection_modifyitems(self, items):
-        for item in items:
-            wrap_array_interceptor(self, item)
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_runtest_call(self, item):
+        if item.get_closest_marker('array_compare') is None:
+            return
+        if not getattr(item.obj, '_arraydiff_wrapped', False):
+            item.obj = _discard_return_value(item.obj)
 
 
 class ArrayCompareFixture:
@@ -422,11 +3255,22 @@ class ArrayCompareFixture:
         if self._comparison is None:
             # Array comparison not requested this run (no --arraydiff); no-op,
             # mirroring the marker-based API.
+            _drain(array)
             return
-        _compare_array(array, self._request.node, kwargs,
-                       plugin_reference_dir=self._comparison.reference_dir,
-                       generate_dir=self._comparison.generate_dir,
-                       default_format=self._comparison.default_format)
+        # Always compared synchronously, even with --arraydiff-async, since
+        # the test may modify the array after calling check.
+        self._comparison.compare(self._request.node, array, kwargs)
+
+    def check_many(self, arrays, **kwargs):
+        """
+        Compare several named arrays, given as a dict, against a single
+        reference file. The arrays are stored in a ``.npz`` file, or as the
+        extensions of a FITS file with ``file_format='fits'``, and ``atol``
+        and ``rtol`` can be dicts giving the tolerance for each array.
+        """
+        if not isinstance(arrays, dict):
+            raise TypeError("check_many expects a dict of arrays")
+        self.check(arrays, **kwargs)
 
 
 @pytest.fixture
@@ -1,6 +1,8 @@
 import os
+import json
 import subprocess
 import tempfile
+from urllib.parse import urlsplit
 
 import pytest
 import numpy as np
@@ -30,6 +32,13 @@ def test_succeeds_func_pdhdf():
                         columns=['test_data'])
 
 
+@pytest.mark.array_compare(file_format='arrow', reference_dir=reference_dir)
+def test_succeeds_func_arrow():
+    pytest.importorskip('pyarrow')
+    pd = pytest.importorskip('pandas')
+    return pd.DataFrame({'flux': np.linspace(0, 1, 20), 'id': np.arange(20), 'name': list('abcde') * 4})
+
+
 @pytest.mark.array_compare(file_format='fits', reference_dir=reference_dir)
 def test_succeeds_func_fits():
     return np.arange(3 * 5).reshape((3, 5)).astype(np.int64)
@@ -208,6 +217,45 @@ def test_parallel_iterations(pytester):
     assert result.ret == 0
 
 
+TEST_INVOCATIONS = """
+import itertools
+import threading
+import pytest
+import numpy as np
+
+lock = threading.Lock()
+counter = itertools.count()
+
+@pytest.mark.array_compare(file_format='npy')
+def test_invocations():
+    with lock:
+        index = next(counter)
+    return np.arange(10.) + (index == 1)
+"""
+
+
+def test_parallel_invocations(pytester):
+    """Every invocation of a test run by pytest-run-parallel is compared."""
+    pytest.importorskip('pytest_run_parallel')
+
+    pytester.makepyfile(test_invocations=TEST_INVOCATIONS)
+    gen_dir = pytester.path / 'reference'
+
+    result = pytester.runpytest_subprocess(f'--arraydiff-generate-path={gen_dir}')
+    assert result.ret == 0
+
+    # The second invocation differs, even though the last one matches
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}',
+                                           '--iterations=3')
+    assert result.ret == 1
+    result.stdout.fnmatch_lines(['*1 of 3 invocations of the test differ from the reference, including invocation 1:*'])
+
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}',
+                                           '--parallel-threads=4', '--iterations=2')
+    assert result.ret == 1
+    result.stdout.fnmatch_lines(['*1 of 8 invocations of the test differ from the reference*'])
+
+
 # ---------------------------------------------------------------------------
 # Fixture-based API (alternative to the @pytest.mark.array_compare marker)
 # ---------------------------------------------------------------------------
@@ -281,3 +329,1282 @@ def test_fixture_parallel_detection(pytester):
         '--parallel-threads=2', '--iterations=3', '--mark-warnings-as-unsafe',
     )
     assert result.ret == 0
+
+
+TEST_IN_MEMORY = """
+import pytest
+import numpy as np
+
+@pytest.mark.array_compare(file_format='{file_format}')
+def test_in_memory():
+    return np.arange(3 * 5).reshape((3, 5)) * {factor}
+"""
+
+
+@pytest.mark.parametrize('file_format', ('fits', 'text'))
+def test_in_memory_comparison(pytester, monkeypatch, file_format):
+    """Temporary files are only written when a comparison fails."""
+    pytester.makepyfile(test_mem=TEST_IN_MEMORY.format(file_format=file_format, factor=0.1))
+    gen_dir = pytester.path / 'reference'
+    result = pytester.runpytest_subprocess(f'--arraydiff-generate-path={gen_dir}')
+    assert result.ret == 0
+
+    tmp_dir = pytester.path / 'tmp'
+    tmp_dir.mkdir()
+    monkeypatch.setenv('TMPDIR', str(tmp_dir))
+
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}')
+    assert result.ret == 0
+    assert list(tmp_dir.iterdir()) == []
+
+    pytester.makepyfile(test_mem=TEST_IN_MEMORY.format(file_format=file_format, factor=0.2))
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}')
+    assert result.ret == 1
+    result_dirs = list(tmp_dir.iterdir())
+    assert len(result_dirs) == 1
+    assert sorted(p.name.split('.')[0] for p in result_dirs[0].iterdir()) == ['reference-test_in_memory', 'test_in_memory']
+
+
+TEST_CACHE = """
+import pytest
+import numpy as np
+
+@pytest.mark.array_compare(file_format='fits', single_reference=True)
+@pytest.mark.parametrize('spam', range(5))
+def test_cache(spam):
+    return np.arange(3 * 5).reshape((3, 5))
+"""
+
+
+def test_reference_cache(pytester):
+    """A single reference shared by parametrized tests is parsed once."""
+    pytester.makepyfile(test_cache=TEST_CACHE)
+    gen_dir = pytester.path / 'reference'
+    result = pytester.runpytest_subprocess(f'--arraydiff-generate-path={gen_dir}', 'test_cache.py::test_cache[0]')
+    assert result.ret == 0
+
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines(['arraydiff reference cache: 4 hits, 1 misses, 0 evictions'])
+
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}',
+                                           '--arraydiff-memory-cache=0')
+    assert result.ret == 0
+    result.stdout.no_fnmatch_line('arraydiff reference cache*')
+
+
+def test_reference_cache_size(tmp_path):
+    """The cache is charged with the size of the decoded references in memory."""
+    from pytest_arraydiff.plugin import FORMATS, ReferenceCache, _write
+
+    array = np.zeros((100, 1000))
+    for filename, file_format in (('array.npy', 'npy'), ('array.npy.gz', 'npy'),
+                                  ('array.txt.gz', 'text'), ('other.txt.gz', 'text')):
+        _write(file_format, str(tmp_path / filename), array, {})
+    cache = ReferenceCache(max_bytes=array.nbytes * 3 // 2)
+    read = {name: (lambda filename, file_format=file_format: FORMATS[file_format].read_reference(filename))
+            for name, file_format in (('npy', 'npy'), ('text', 'text'))}
+
+    # Memory-mapped npy references hold no decoded data, and compressed ones
+    # are not cached at all
+    for _ in range(2):
+        cache.get(str(tmp_path / 'array.npy'), read['npy'])
+        cache.get(str(tmp_path / 'array.npy.gz'), read['npy'])
+    assert (cache.hits, cache.misses, cache.evictions) == (1, 3, 0)
+
+    # Compressed text references are small on disk but not in memory, so
+    # two of them do not fit
+    assert os.path.getsize(tmp_path / 'array.txt.gz') < array.nbytes / 100
+    cache.get(str(tmp_path / 'array.txt.gz'), read['text'])
+    cache.get(str(tmp_path / 'array.txt.gz'), read['text'])
+    assert (cache.hits, cache.misses, cache.evictions) == (2, 4, 0)
+    cache.get(str(tmp_path / 'other.txt.gz'), read['text'])
+    assert (cache.hits, cache.misses, cache.evictions) == (2, 5, 2)
+
+
+def test_reference_cache_entries(tmp_path):
+    """Memory-mapped references count towards the maximum number of entries."""
+    from pytest_arraydiff.plugin import NPYDiff, ReferenceCache
+
+    for index in range(3):
+        NPYDiff.write(str(tmp_path / f'{index}.npy'), np.zeros(10))
+    cache = ReferenceCache(max_bytes=1024 ** 2, max_entries=2)
+    for index in range(3):
+        cache.get(str(tmp_path / f'{index}.npy'), NPYDiff.read_reference)
+    assert (cache.hits, cache.misses, cache.evictions) == (0, 3, 1)
+    cache.get(str(tmp_path / '2.npy'), NPYDiff.read_reference)
+    cache.get(str(tmp_path / '0.npy'), NPYDiff.read_reference)
+    assert (cache.hits, cache.misses, cache.evictions) == (1, 4, 2)
+
+
+@pytest.mark.array_compare(file_format='npy', reference_dir=reference_dir)
+def test_succeeds_func_npy():
+    return np.arange(3 * 5).reshape((3, 5)).astype(np.float32)
+
+
+def test_memory_mapped_references(tmp_path):
+    from astropy.io import fits
+    from pytest_arraydiff.plugin import FITSDiff, NPYDiff
+
+    array = np.arange(3 * 5).reshape((3, 5)).astype(np.float64)
+
+    NPYDiff.write(str(tmp_path / 'ref.npy'), array)
+    reference = NPYDiff.read_reference(str(tmp_path / 'ref.npy'))
+    assert isinstance(reference, np.memmap)
+    assert NPYDiff.compare_data(reference, array, atol=0, rtol=1e-7)
+
+    FITSDiff.write(str(tmp_path / 'ref.fits'), fits.HDUList([fits.PrimaryHDU(array), fits.ImageHDU(array)]))
+    reference = FITSDiff.read_reference(str(tmp_path / 'ref.fits'))
+    assert reference[1].data.base is not None
+    assert FITSDiff.compare_data(reference, fits.HDUList([fits.PrimaryHDU(array), fits.ImageHDU(array)]), atol=0, rtol=1e-7)
+    assert not FITSDiff.compare_data(reference, fits.HDUList([fits.PrimaryHDU(array), fits.ImageHDU(array + 1)]), atol=0, rtol=1e-7)
+
+    # Scaled images cannot be memory-mapped and are read in full instead
+    FITSDiff.write(str(tmp_path / 'scaled.fits'), array.astype(np.uint16))
+    reference = FITSDiff.read_reference(str(tmp_path / 'scaled.fits'))
+    assert FITSDiff.compare_data(reference, array.astype(np.uint16), atol=0, rtol=1e-7)
+
+
+@pytest.mark.parametrize(('reference', 'data', 'expected'), [
+    (np.arange(100000.), np.arange(100000.), True),
+    (np.arange(100000.), np.arange(100000.) * (1 + 1e-9), True),
+    (np.arange(100000.), np.arange(100000.) + 1e-3, False),
+    (np.arange(100000.).reshape((100, 1000)), np.asfortranarray(np.arange(100000.).reshape((100, 1000))), True),
+    (np.arange(100000.).reshape((100, 1000)), np.arange(100000.).reshape((1000, 100)), False),
+    (np.array([1., np.nan, np.inf]), np.array([1., np.nan, np.inf]), True),
+    (np.array([1., np.nan, np.inf]), np.array([1., 2., np.inf]), False),
+    (np.array([1., 2., np.inf]), np.array([1., 2., -np.inf]), False),
+    (np.arange(10, dtype=np.uint8), np.arange(10, dtype=np.int64), True),
+    (np.array(['a', 'b']), np.array(['a', 'b']), False),
+])
+def test_allclose_blockwise(reference, data, expected):
+    from pytest_arraydiff.plugin import _allclose_blockwise
+    assert _allclose_blockwise(reference, data, atol=0, rtol=1e-7, block_size=4096) is expected
+
+
+TEST_REMOTE = """
+import pytest
+import numpy as np
+
+@pytest.mark.array_compare(reference_dir='{url}', file_format='fits', single_reference=True, atol=1.5)
+@pytest.mark.parametrize('spam', range(4))
+def test_single_reference(spam):
+    return np.ones((3, 4)) * 1.6 + 1.4
+
+@pytest.mark.array_compare(reference_dir='{url}', file_format='text')
+def test_succeeds_func_text():
+    return np.arange(3 * 5).reshape((3, 5))
+"""
+
+
+@pytest.fixture
+def reference_server():
+    """Serve the baseline directory over HTTP, recording the requests made."""
+    import functools
+    import threading
+    from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+    requests = []
+
+    class Handler(SimpleHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_request(self, code='-', size='-'):
+            requests.append((self.client_address, self.path, int(code)))
+
+        def translate_path(self, path):
+            # Also serve the files when acting as a proxy, with absolute URLs
+            return super().translate_path(urlsplit(path).path)
+
+    handler = functools.partial(Handler, directory=os.path.join(os.path.dirname(__file__), reference_dir))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}/', requests
+    server.shutdown()
+    server.server_close()
+
+
+def test_remote_prefetch(pytester, reference_server):
+    """Remote references are downloaded once each, over a reused connection."""
+    url, requests = reference_server
+    pytester.makepyfile(test_remote=TEST_REMOTE.format(url=url))
+
+    result = pytester.runpytest_subprocess('--arraydiff', '--arraydiff-download-workers=1')
+    assert result.ret == 0
+    result.assert_outcomes(passed=5)
+    assert sorted(path for _, path, _ in requests) == ['/test_single_reference.fits', '/test_succeeds_func_text.txt']
+    assert len({client for client, _, _ in requests}) == 1
+
+    requests.clear()
+    result = pytester.runpytest_subprocess('--arraydiff', '-k', 'text')
+    assert result.ret == 0
+    assert [path for _, path, _ in requests] == ['/test_succeeds_func_text.txt']
+
+
+def test_remote_proxy(reference_server, monkeypatch):
+    """Remote references are fetched through the proxy set in the environment."""
+    from pytest_arraydiff.plugin import RemoteReferences
+
+    url, requests = reference_server
+    monkeypatch.setenv('http_proxy', url)
+    monkeypatch.delenv('no_proxy', raising=False)
+    monkeypatch.delenv('NO_PROXY', raising=False)
+    remote_references = RemoteReferences()
+    try:
+        filename = remote_references.get('http://reference.invalid/test_succeeds_func_text.txt')
+        np.testing.assert_array_equal(np.loadtxt(filename), np.arange(3 * 5).reshape((3, 5)))
+    finally:
+        remote_references.close()
+    assert [path for _, path, _ in requests] == ['http://reference.invalid/test_succeeds_func_text.txt']
+
+    # Hosts in no_proxy are connected to directly
+    requests.clear()
+    monkeypatch.setenv('no_proxy', '127.0.0.1')
+    remote_references = RemoteReferences()
+    try:
+        remote_references.get(url + 'test_succeeds_func_text.txt')
+    finally:
+        remote_references.close()
+    assert [path for _, path, _ in requests] == ['/test_succeeds_func_text.txt']
+
+
+def test_remote_cache(pytester, reference_server):
+    """Cached remote references are revalidated rather than downloaded again."""
+    url, requests = reference_server
+    pytester.makepyfile(test_remote=TEST_REMOTE.format(url=url))
+    cache_dir = pytester.path / 'cache'
+
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-cache-dir={cache_dir}')
+    assert result.ret == 0
+    assert sorted(code for _, _, code in requests) == [200, 200]
+    assert len(list((cache_dir / 'objects').iterdir())) == 2
+
+    requests.clear()
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-cache-dir={cache_dir}')
+    assert result.ret == 0
+    assert sorted(code for _, _, code in requests) == [304, 304]
+
+    # Files over the size budget are evicted at the end of the session
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-cache-dir={cache_dir}',
+                                           '--arraydiff-cache-size=0')
+    assert result.ret == 0
+    assert len(list((cache_dir / 'objects').iterdir())) == 0
+
+
+TEST_MANIFEST = """
+import pytest
+import numpy as np
+
+@pytest.mark.array_compare(file_format='npy')
+def test_manifest():
+    return np.arange(3 * 5).reshape((3, 5)) + {offset}
+"""
+
+
+def test_manifest_fast_path(pytester):
+    """Results matching the manifest digest do not read the reference."""
+    import json
+
+    pytester.makepyfile(test_manifest=TEST_MANIFEST.format(offset=0))
+    gen_dir = pytester.path / 'reference'
+    result = pytester.runpytest_subprocess(f'--arraydiff-generate-path={gen_dir}', '--arraydiff-manifest')
+    assert result.ret == 0
+    manifest = json.loads((gen_dir / 'arraydiff-manifest.json').read_text())
+    assert manifest['test_manifest.npy']['shape'] == [3, 5]
+
+    # Corrupt the reference data without changing its size: the manifest
+    # shows that the result is identical, so the reference is never read.
+    reference = gen_dir / 'test_manifest.npy'
+    content = reference.read_bytes()
+    reference.write_bytes(content[:-8] + b'\xff' * 8)
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}')
+    assert result.ret == 0
+
+    # Once the size of the file changes, the manifest no longer applies
+    reference.write_bytes(content[:-8])
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}')
+    assert result.ret == 1
+
+    # A different result falls back to comparing with the reference
+    reference.write_bytes(content)
+    pytester.makepyfile(test_manifest=TEST_MANIFEST.format(offset=1))
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}')
+    assert result.ret == 1
+    result.stdout.fnmatch_lines(['*Not equal to tolerance*'])
+
+    # Regenerating without the manifest option drops the stale entry
+    result = pytester.runpytest_subprocess(f'--arraydiff-generate-path={gen_dir}')
+    assert result.ret == 0
+    assert json.loads((gen_dir / 'arraydiff-manifest.json').read_text()) == {}
+    pytester.makepyfile(test_manifest=TEST_MANIFEST.format(offset=0))
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}')
+    assert result.ret == 1
+    pytester.makepyfile(test_manifest=TEST_MANIFEST.format(offset=1))
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}')
+    assert result.ret == 0
+
+
+def test_array_digest():
+    from pytest_arraydiff.plugin import _array_digest
+    array = np.arange(100000.).reshape((100, 1000))
+    digest = _array_digest(array)
+    assert _array_digest(np.asfortranarray(array)) == digest
+    assert _array_digest(array.astype('>f8')) == digest
+    assert _array_digest(array.reshape((1000, 100))) != digest
+    assert _array_digest(array.astype(np.float32)) != digest
+    assert _array_digest(array.tolist()) is None
+
+
+TEST_ASYNC = """
+import pytest
+import numpy as np
+
+@pytest.mark.array_compare(file_format='text')
+@pytest.mark.parametrize('spam', range(3))
+def test_async(spam):
+    return np.arange(3 * 5).reshape((3, 5)) * spam
+
+@pytest.mark.array_compare(file_format='text')
+def test_async_fail():
+    return np.arange(3 * 5).reshape((3, 5)) + {offset}
+"""
+
+
+def test_async_comparison(pytester):
+    """Failures of background comparisons are reported as errors."""
+    pytester.makepyfile(test_async=TEST_ASYNC.format(offset=0))
+    gen_dir = pytester.path / 'reference'
+    result = pytester.runpytest_subprocess(f'--arraydiff-generate-path={gen_dir}')
+    assert result.ret == 0
+
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}', '--arraydiff-async')
+    assert result.ret == 0
+    result.assert_outcomes(passed=4)
+
+    pytester.makepyfile(test_async=TEST_ASYNC.format(offset=1))
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}', '--arraydiff-async')
+    assert result.ret == 1
+    result.assert_outcomes(passed=4, errors=1)
+    result.stdout.fnmatch_lines(['*ERROR at teardown of test_async_fail*', '*Not equal to tolerance*'])
+
+
+def test_comparison_queue_memory_limit():
+    """The size of the data in flight is kept under the limit."""
+    import threading
+    import time
+    from pytest_arraydiff.plugin import ComparisonQueue
+
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def compare():
+        with lock:
+            running.append(None)
+            peak.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.pop()
+
+    queue = ComparisonQueue(max_workers=4, max_bytes=100)
+    for _ in range(8):
+        queue.submit(None, 60, compare)
+    assert len(queue.pop_completed(wait_all=True)) == 8
+    queue.close()
+    assert max(peak) == 1
+
+
+def test_comparison_queue_completed_during_pop():
+    """A comparison that completes while completed ones are collected is not lost."""
+    from pytest_arraydiff.plugin import ComparisonQueue
+
+    class Future:
+        # Completes on a worker thread just after the first check
+        checks = 0
+
+        def done(self):
+            self.checks += 1
+            return self.checks > 1
+
+    queue = ComparisonQueue(max_workers=1, max_bytes=100)
+    future = Future()
+    queue._pending.append(('item', future))
+    assert queue.pop_completed() == []
+    assert queue.pop_completed() == [('item', future)]
+    assert queue.pop_completed() == []
+    queue.close()
+
+
+def test_reference_writer_memory_limit(tmp_path, monkeypatch):
+    """The size of the arrays waiting to be written is kept under the limit."""
+    import threading
+    import time
+    from pytest_arraydiff import plugin
+
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def write_atomic(file_format, filename, data, write_kwargs):
+        with lock:
+            running.append(None)
+            peak.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.pop()
+
+    monkeypatch.setattr(plugin, '_write_atomic', write_atomic)
+    writer = plugin.ReferenceWriter(max_workers=4, max_bytes=100)
+    for index in range(8):
+        writer.submit('npy', str(tmp_path / f'{index}.npy'), np.zeros(10), {})
+    writer.close()
+    assert not writer.errors
+    assert len(peak) == 8 and max(peak) == 1
+
+
+TEST_WRITER = """
+import pytest
+import numpy as np
+
+@pytest.mark.array_compare(file_format='fits')
+@pytest.mark.parametrize('spam', range(10))
+def test_writer(spam):
+    return np.arange(3 * 5).reshape((3, 5)) * spam
+
+@pytest.mark.array_compare(file_format='text')
+def test_writer_error():
+    return np.zeros((2, 3, 4))
+"""
+
+
+def test_reference_writer(pytester):
+    """Reference files are written in the background and errors are reported at the end."""
+    pytester.makepyfile(test_writer=TEST_WRITER)
+    gen_dir = pytester.path / 'reference'
+
+    result = pytester.runpytest_subprocess(f'--arraydiff-generate-path={gen_dir}', '-k', 'not error')
+    assert result.ret == 0
+    result.assert_outcomes(skipped=10)
+    assert sorted(path.name for path in gen_dir.iterdir()) == [f'test_writer_{spam}.fits' for spam in range(10)]
+
+    # Existing files are replaced
+    result = pytester.runpytest_subprocess(f'--arraydiff-generate-path={gen_dir}', '-k', 'not error')
+    assert result.ret == 0
+
+    result = pytester.runpytest_subprocess(f'--arraydiff-generate-path={gen_dir}')
+    assert result.ret == 1
+    result.stdout.fnmatch_lines(['*arraydiff: errors writing reference files*',
+                                 '*test_writer_error.txt: ValueError:*'])
+    assert len(list(gen_dir.iterdir())) == 10
+
+
+def test_profile(pytester):
+    """The time spent in each phase is summarized and written to JSON."""
+    import json
+
+    pytester.makepyfile(test_mem=TEST_IN_MEMORY.format(file_format='fits', factor=0.1))
+    gen_dir = pytester.path / 'reference'
+    result = pytester.runpytest_subprocess(f'--arraydiff-generate-path={gen_dir}')
+    assert result.ret == 0
+
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}',
+                                           '--arraydiff-profile', '--arraydiff-profile-json=profile.json')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines(['*arraydiff profile*', 'phase*seconds*MB', 'slowest 10 tests:',
+                                 '*s test_mem.py::test_in_memory (*)'])
+    profiles = json.loads((pytester.path / 'profile.json').read_text())
+    assert [profile['nodeid'] for profile in profiles] == ['test_mem.py::test_in_memory']
+    assert set(profiles[0]['phases']) == {'test', 'read', 'compare'}
+    assert profiles[0]['phases']['read']['bytes'] == (gen_dir / 'test_in_memory.fits').stat().st_size
+
+
+TEST_DISABLED = """
+import gc
+import sys
+import weakref
+import pytest
+
+class Array(list):
+    pass
+
+refs = []
+
+@pytest.mark.array_compare
+@pytest.mark.parametrize('spam', range(3))
+def test_disabled(spam):
+    array = Array([spam])
+    refs.append(weakref.ref(array))
+    return array
+
+def test_lazy_imports():
+    assert 'numpy' not in sys.modules
+    gc.collect()
+    assert [ref() for ref in refs] == [None, None, None]
+"""
+
+
+def test_disabled_overhead(pytester):
+    """Without --arraydiff, NumPy is not imported and returned arrays are not kept."""
+    pytester.makepyfile(test_disabled=TEST_DISABLED)
+    # pytest-run-parallel imports NumPy itself
+    result = pytester.runpytest_subprocess('-p', 'no:run-parallel', '-W', 'error')
+    assert result.ret == 0
+    result.assert_outcomes(passed=4)
+
+
+TEST_RELEASE = """
+import gc
+import weakref
+import pytest
+import numpy as np
+
+refs = []
+
+@pytest.mark.array_compare(file_format='npy')
+@pytest.mark.parametrize('spam', range(3))
+def test_release(spam):
+    array = np.full(128 * 1024, spam, dtype=float)
+    refs.append(weakref.ref(array))
+    return array
+
+def test_released():
+    gc.collect()
+    assert len(refs) == 3
+    assert all(ref() is None for ref in refs)
+"""
+
+
+def test_release_arrays(pytester):
+    """Returned arrays are released once compared, and the peak resident size is reported."""
+    pytester.makepyfile(test_release=TEST_RELEASE)
+    gen_dir = pytester.path / 'reference'
+
+    # References are written in the background, so may still be held when test_released runs
+    result = pytester.runpytest_subprocess(f'--arraydiff-generate-path={gen_dir}', '--arraydiff-memory-report',
+                                           '-k', 'not released')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines(['arraydiff captured arrays: peak of * MB resident (while running *)'])
+
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}',
+                                           '--arraydiff-memory-report')
+    assert result.ret == 0
+    result.assert_outcomes(passed=4)
+    result.stdout.fnmatch_lines(['arraydiff captured arrays: peak of 1.0 MB resident '
+                                 '(while running test_release.py::test_release[[]0[]])'])
+
+
+TEST_PACK = """
+import pytest
+import numpy as np
+from astropy.io import fits
+
+@pytest.mark.array_compare(file_format='{file_format}')
+@pytest.mark.parametrize('spam', range(3))
+def test_pack(spam):
+    return np.arange(3 * 5).reshape((3, 5)) * {factor} + spam
+
+@pytest.mark.array_compare(file_format='fits')
+def test_pack_hdu():
+    return fits.PrimaryHDU(np.arange(3 * 5).reshape((3, 5)))
+"""
+
+
+CONFTEST_NO_EXISTS = """
+import os
+
+exists = os.path.exists
+
+
+def exists_unless_packed(path):
+    assert not os.path.basename(path).startswith('test_pack_'), path
+    return exists(path)
+
+
+os.path.exists = exists_unless_packed
+"""
+
+
+@pytest.mark.parametrize('file_format', ('text', 'npy', 'fits'))
+def test_packed_references(pytester, file_format):
+    """Plain arrays can be generated into, and compared against, a single archive."""
+    pytester.makepyfile(test_pack=TEST_PACK.format(file_format=file_format, factor=0.1))
+    gen_dir = pytester.path / 'reference'
+    result = pytester.runpytest_subprocess(f'--arraydiff-generate-path={gen_dir}', '--arraydiff-pack',
+                                           '-k', 'not spam and not 2')
+    assert result.ret == 0
+    # HDUs are not plain arrays, so are still written to separate files
+    assert sorted(path.name for path in gen_dir.iterdir()) == ['arraydiff-references.pack', 'test_pack_hdu.fits']
+
+    # Archives are updated rather than replaced
+    result = pytester.runpytest_subprocess(f'--arraydiff-generate-path={gen_dir}', '--arraydiff-pack', '-k', '2')
+    assert result.ret == 0
+
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}')
+    assert result.ret == 0
+    result.assert_outcomes(passed=4)
+
+    # Packed references are found without checking for per-test files
+    conftest = pytester.makeconftest(CONFTEST_NO_EXISTS)
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}', '-k', 'not hdu')
+    assert result.ret == 0
+    result.assert_outcomes(passed=3)
+    conftest.unlink()
+
+    pytester.makepyfile(test_pack=TEST_PACK.format(file_format=file_format, factor=0.2))
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}')
+    assert result.ret == 1
+    result.assert_outcomes(passed=1, failed=3)
+    result.stdout.fnmatch_lines(['*reference-test_pack_1.*'])
+
+    # Files generated without --arraydiff-pack replace their archive entries
+    result = pytester.runpytest_subprocess(f'--arraydiff-generate-path={gen_dir}', '-k', '1')
+    assert result.ret == 0
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}')
+    result.assert_outcomes(passed=2, failed=2)
+    result = pytester.runpytest_subprocess(f'--arraydiff-generate-path={gen_dir}')
+    assert result.ret == 0
+    assert 'arraydiff-references.pack' not in [path.name for path in gen_dir.iterdir()]
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}')
+    result.assert_outcomes(passed=4)
+
+
+def test_reference_archive(tmp_path):
+    from pytest_arraydiff.plugin import ReferenceArchive
+
+    arrays = {'float': np.linspace(0, 1, 10),
+              'big_endian': np.arange(12, dtype='>i4').reshape((3, 4)),
+              'fortran': np.asfortranarray(np.ones((3, 2))),
+              'scalar': np.array(3.5),
+              'empty': np.zeros((0, 3)),
+              'bool': np.array([True, False])}
+    archive = ReferenceArchive()
+    for name, array in arrays.items():
+        assert archive.accepts(array)
+        archive.add(str(tmp_path), name, array)
+    archive.save()
+    assert not archive.accepts(np.array([None]))
+    assert not archive.accepts([1, 2])
+    assert [path.name for path in tmp_path.iterdir()] == ['arraydiff-references.pack']
+
+    archive = ReferenceArchive()
+    for name, array in arrays.items():
+        reference = archive.get(str(tmp_path), name)
+        assert reference.dtype == array.dtype
+        np.testing.assert_array_equal(reference, array)
+    assert archive.get(str(tmp_path), 'missing') is None
+    assert archive.get(str(tmp_path / 'missing'), 'float') is None
+    archive.close()
+
+
+TEST_MANY = """
+import pytest
+import numpy as np
+
+def outputs():
+    return {{'flux': np.linspace(1, 2, 10) * (1 + {noise}), 'counts': np.arange(10)}}
+
+@pytest.mark.array_compare(file_format='{file_format}', rtol={{'flux': 1e-3}})
+def test_many_marker():
+    return outputs()
+
+def test_many_fixture(array_compare):
+    array_compare.check_many(outputs(), file_format='{file_format}', rtol={{'flux': 1e-3}})
+
+@pytest.mark.array_compare
+def test_many_default():
+    return outputs()
+"""
+
+
+@pytest.mark.parametrize('file_format', ('npz', 'fits'))
+def test_many_arrays(pytester, file_format):
+    """Dicts of arrays are stored in one container file, with per-array tolerances."""
+    pytester.makepyfile(test_many=TEST_MANY.format(file_format=file_format, noise=0))
+    gen_dir = pytester.path / 'reference'
+    result = pytester.runpytest_subprocess(f'--arraydiff-generate-path={gen_dir}')
+    assert result.ret == 0
+    assert sorted(path.name for path in gen_dir.iterdir()) == [
+        'test_many_default.npz', f'test_many_fixture.{file_format}', f'test_many_marker.{file_format}']
+
+    pytester.makepyfile(test_many=TEST_MANY.format(file_format=file_format, noise=1e-5))
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}')
+    result.assert_outcomes(passed=2, failed=1)
+    result.stdout.fnmatch_lines(['FAILED test_many.py::test_many_default - *'])
+
+    pytester.makepyfile(test_many=TEST_MANY.format(file_format=file_format, noise=1e-2))
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}')
+    result.assert_outcomes(failed=3)
+    result.stdout.fnmatch_lines(["*FLUX*" if file_format == 'fits' else "*Array 'flux'*"])
+    result.stdout.no_fnmatch_line("*Array 'counts'*")
+
+
+def test_many_arrays_errors(array_compare):
+    with pytest.raises(TypeError, match='dict of arrays'):
+        array_compare.check_many(np.arange(3))
+
+
+@pytest.mark.parametrize(('array', 'write_kwargs'), [
+    (np.linspace(0, 1, 100), {}),
+    (np.arange(12).reshape((3, 4)), {'fmt': '%d'}),
+    (np.linspace(0, 1, 10, dtype=np.float32).reshape((5, 2)), {'fmt': '%.3e', 'delimiter': ','}),
+    (np.array([np.nan, np.inf, -0.]), {'newline': '\r\n'}),
+    (np.zeros((0,)), {}),
+    (np.ones((2, 2)), {'header': 'spam'}),
+    (np.ones((2, 3)), {'fmt': '%g %g %.1f'}),
+    (np.linspace(0, 1, 3 * 50000).reshape((50000, 3)), {}),
+])
+@pytest.mark.parametrize('extension', ('txt', 'txt.gz'))
+def test_text_writer(tmp_path, array, write_kwargs, extension):
+    """The text writer gives the same bytes as np.savetxt."""
+    import gzip
+    from pytest_arraydiff.plugin import TextDiff
+
+    TextDiff.write(tmp_path / f'fast.{extension}', array, **write_kwargs)
+    np.savetxt(tmp_path / f'savetxt.{extension}', array, **dict({'fmt': '%g'}, **write_kwargs))
+    opener = gzip.open if extension == 'txt.gz' else open
+    with opener(tmp_path / f'fast.{extension}', 'rb') as fast, opener(tmp_path / f'savetxt.{extension}', 'rb') as savetxt:
+        assert fast.read() == savetxt.read()
+
+
+def test_text_writer_memory(tmp_path):
+    """The text writer formats a bounded number of rows at a time."""
+    import tracemalloc
+    from pytest_arraydiff.plugin import TextDiff
+
+    array = np.linspace(0, 1, 3 * 400000).reshape((400000, 3))
+    tracemalloc.start()
+    try:
+        TextDiff.write(tmp_path / 'array.txt', array)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < array.nbytes / 2
+    np.testing.assert_array_equal(TextDiff.roundtrip(array), TextDiff.read(tmp_path / 'array.txt'))
+
+
+@pytest.mark.array_compare(reference_dir=reference_dir, extension='txt.gz')
+def test_succeeds_func_text_gz():
+    return np.arange(3 * 5).reshape((3, 5))
+
+
+def test_fits_fast_path(tmp_path, monkeypatch):
+    """Identical FITS files are recognized without building astropy's diff."""
+    from astropy.io import fits
+    from astropy.io.fits import diff
+    from pytest_arraydiff.plugin import FITSDiff
+
+    def hdulist(scale=1., exptime=1.):
+        image = fits.ImageHDU(np.arange(1., 101.).reshape((10, 10)) * scale, name='SCI')
+        image.header['EXPTIME'] = exptime
+        table = fits.BinTableHDU.from_columns([fits.Column(name='flux', format='D', array=np.linspace(0, 1, 5)),
+                                               fits.Column(name='id', format='K', array=np.arange(5)),
+                                               fits.Column(name='name', format='5A', array=['a', 'b', 'c', 'd', 'e'])])
+        return fits.HDUList([fits.PrimaryHDU(), image, table])
+
+    hdulist().writeto(tmp_path / 'reference.fits')
+    reference = FITSDiff.read_reference(tmp_path / 'reference.fits')
+    hdulist().writeto(tmp_path / 'same.fits')
+    hdulist(scale=2).writeto(tmp_path / 'different.fits')
+
+    with monkeypatch.context() as m:
+        m.setattr(diff, 'FITSDiff', None)
+        assert FITSDiff.compare_data(reference, hdulist(), atol=0, rtol=1e-7)
+        assert FITSDiff.compare(tmp_path / 'reference.fits', tmp_path / 'same.fits', atol=0, rtol=1e-7) == (True, "")
+        assert FITSDiff._identical(reference, hdulist(scale=2), atol=0, rtol=1e-7) is False
+        assert FITSDiff._identical(reference, hdulist(scale=1 + 1e-9), atol=0, rtol=1e-7) is True
+        assert FITSDiff._identical(reference, hdulist()[:2], atol=0, rtol=1e-7) is False
+        # Headers that differ are left to astropy, as they may match within the tolerances
+        assert FITSDiff._identical(reference, hdulist(exptime=1 + 1e-9), atol=0, rtol=1e-7) is None
+
+    assert FITSDiff.compare_data(reference, hdulist(exptime=1 + 1e-9), atol=0, rtol=1e-7)
+    assert not FITSDiff.compare_data(reference, hdulist(exptime=2), atol=0, rtol=1e-7)
+    identical, report = FITSDiff.compare(tmp_path / 'reference.fits', tmp_path / 'different.fits', atol=0, rtol=1e-7)
+    assert not identical
+    assert 'different.fits' in report
+
+
+TEST_ARROW = """
+import pytest
+import numpy as np
+import pandas as pd
+
+@pytest.mark.array_compare(file_format='arrow', rtol={{'flux': 1e-3}})
+def test_arrow_frame():
+    return pd.DataFrame({{'flux': np.linspace(1, 2, 10) * (1 + {noise}), 'counts': np.arange(10),
+                          'band': list('{bands}')}})
+
+@pytest.mark.array_compare(file_format='arrow')
+def test_arrow_dict():
+    return {{'flux': np.linspace(1, 2, 10) * (1 + {noise})}}
+"""
+
+
+def test_arrow_format(pytester):
+    """DataFrames are compared column by column, with per-column tolerances."""
+    pytest.importorskip('pyarrow')
+    pytest.importorskip('pandas')
+    pytester.makepyfile(test_arrow=TEST_ARROW.format(noise=0, bands='ugrizugriz'))
+    gen_dir = pytester.path / 'reference'
+    result = pytester.runpytest_subprocess(f'--arraydiff-generate-path={gen_dir}')
+    assert result.ret == 0
+    assert sorted(path.name for path in gen_dir.iterdir()) == ['test_arrow_dict.arrow', 'test_arrow_frame.arrow']
+
+    pytester.makepyfile(test_arrow=TEST_ARROW.format(noise=1e-5, bands='ugrizugriz'))
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}')
+    result.assert_outcomes(passed=1, failed=1)
+    result.stdout.fnmatch_lines(["*Column 'flux':*", 'FAILED test_arrow.py::test_arrow_dict - *'])
+
+    pytester.makepyfile(test_arrow=TEST_ARROW.format(noise=1e-2, bands='ugrizugrix'))
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}')
+    result.assert_outcomes(failed=2)
+    result.stdout.fnmatch_lines(["*Column 'band': 1 / 10 values differ, first at row 9: 'x' != 'z'*"])
+    result.stdout.no_fnmatch_line("*Column 'counts'*")
+
+
+def test_arrow_differences():
+    """The comparison stops at the first column that differs."""
+    pa = pytest.importorskip('pyarrow')
+    from pytest_arraydiff.plugin import ArrowDiff
+
+    reference = pa.table({'a': np.arange(5.), 'b': ['x', None, 'y', 'z', 'w'], 'c': np.arange(5)})
+    assert ArrowDiff.compare_data(reference, reference)
+    assert list(ArrowDiff._differences(reference, pa.table({'a': np.arange(5.) * (1 + 1e-9), 'b': ['x', 'q', 'y', 'z', 'w'],
+                                                            'c': np.arange(5) + 1}))) == ['b', 'c']
+    assert list(ArrowDiff._differences(reference, pa.table({'a': np.arange(5.), 'b': ['x', None, 'y', 'z', 'w'],
+                                                            'c': np.arange(5, dtype=np.int32)}), report=True)) == [
+        "Column 'c': types differ: int32 != int64"]
+    assert not ArrowDiff.compare_data(reference, reference.select(['a', 'b']))
+    assert not ArrowDiff.compare_data(reference, reference.slice(1))
+    assert ArrowDiff.compare_data(reference, {'a': np.arange(5.) * (1 + 1e-3), 'b': ['x', None, 'y', 'z', 'w'],
+                                              'c': np.arange(5)}, rtol={'a': 1e-2})
+
+
+TEST_UPDATE = """
+import pytest
+import numpy as np
+
+@pytest.mark.array_compare(file_format='text')
+def test_update_text():
+    return np.arange(6.).reshape((2, 3)) * {scale}
+
+@pytest.mark.array_compare(file_format='npy')
+def test_update_npy():
+    return np.arange(6.).reshape((2, 3)) * {scale}
+
+@pytest.mark.array_compare(file_format='npy')
+def test_update_unchanged():
+    return np.arange(6.)
+"""
+
+
+@pytest.mark.parametrize('option', ('--arraydiff-manifest', '--arraydiff-pack'))
+def test_update_references(pytester, option):
+    """--arraydiff-update rewrites only the references that are missing or differ."""
+    pytester.makepyfile(test_update=TEST_UPDATE.format(scale=1))
+    gen_dir = pytester.path / 'reference'
+    result = pytester.runpytest_subprocess(f'--arraydiff-generate-path={gen_dir}', option, '-k', 'not unchanged')
+    assert result.ret == 0
+    result = pytester.runpytest_subprocess('--arraydiff-update', f'--arraydiff-reference-path={gen_dir}')
+    result.assert_outcomes(passed=3)
+    result.stdout.fnmatch_lines(['*arraydiff: updated 1 reference files*',
+                                 f'{gen_dir / "test_update_unchanged.npy"} (new)'])
+    unchanged = (gen_dir / 'test_update_unchanged.npy').stat().st_mtime_ns
+
+    pytester.makepyfile(test_update=TEST_UPDATE.format(scale=2))
+    result = pytester.runpytest_subprocess('--arraydiff-update', f'--arraydiff-reference-path={gen_dir}')
+    result.assert_outcomes(passed=3)
+    result.stdout.fnmatch_lines(['*arraydiff: updated 2 reference files*',
+                                 str(gen_dir / 'test_update_npy.npy'),
+                                 str(gen_dir / 'test_update_text.txt')])
+    assert (gen_dir / 'test_update_unchanged.npy').stat().st_mtime_ns == unchanged
+    assert not list(gen_dir.glob('.arraydiff-*'))
+
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}')
+    result.assert_outcomes(passed=3)
+    result.stdout.no_fnmatch_line('*arraydiff: updated*')
+
+
+TEST_SPARSE = """
+import pytest
+import numpy as np
+from scipy import sparse
+
+def matrix():
+    rows = np.arange(0, 10 ** 6, 1000)
+    values = np.linspace(1, 2, len(rows)) * (1 + {noise})
+    return sparse.csr_array((values, (rows, rows[::-1])), shape=(10 ** 6, 10 ** 6))
+
+@pytest.mark.array_compare(file_format='sparse', rtol=1e-3)
+def test_sparse_format():
+    return matrix()
+
+@pytest.mark.array_compare
+def test_sparse_default():
+    return matrix()
+"""
+
+
+def test_sparse_format(pytester):
+    """Sparse arrays are stored and compared without densifying them."""
+    pytest.importorskip('scipy')
+    pytester.makepyfile(test_sparse=TEST_SPARSE.format(noise=0))
+    gen_dir = pytester.path / 'reference'
+    result = pytester.runpytest_subprocess(f'--arraydiff-generate-path={gen_dir}')
+    assert result.ret == 0
+    assert sorted(path.name for path in gen_dir.iterdir()) == ['test_sparse_default.npz', 'test_sparse_format.npz']
+
+    pytester.makepyfile(test_sparse=TEST_SPARSE.format(noise=1e-5))
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}')
+    result.assert_outcomes(passed=1, failed=1)
+    result.stdout.fnmatch_lines(['*Mismatched elements: 1000 / 1000000000000 (1e-07%), out of 1000 stored in either array',
+                                 '*First mismatch at index (0, 999000): *'])
+
+
+def test_sparse_comparison():
+    """Explicit and implicit zeros compare equal, and duplicate entries add up."""
+    sparse = pytest.importorskip('scipy.sparse')
+    from pytest_arraydiff.plugin import SparseDiff
+
+    reference = sparse.coo_array(([1., 2., 0.], ([0, 1, 2], [0, 1, 2])), shape=(3, 3))
+    assert SparseDiff.compare_data(reference, sparse.csr_array(np.diag([1., 2., 0.])), atol=0, rtol=1e-7)
+    assert SparseDiff.compare_data(reference, sparse.coo_array(([1., 1., 1.], ([0, 1, 1], [0, 1, 1])), shape=(3, 3)),
+                                   atol=0, rtol=1e-7)
+    assert SparseDiff.compare_data(reference, sparse.csc_matrix(np.diag([1., 2., 1e-3])), atol=1e-2, rtol=1e-7)
+    assert not SparseDiff.compare_data(reference, sparse.csc_matrix(np.diag([1., 2., 1e-3])), atol=0, rtol=1e-7)
+    assert not SparseDiff.compare_data(reference, sparse.eye_array(4), atol=0, rtol=1e-7)
+    assert not SparseDiff.compare_data(reference, np.diag([1., 2., 0.]), atol=0, rtol=1e-7)
+
+
+TEST_SUMMARY = """
+import pytest
+import numpy as np
+
+@pytest.mark.array_compare(file_format='summary', rtol=1e-3)
+def test_summary_marker():
+    return np.linspace(1, 2, 10 ** 6).reshape((1000, 1000)) * (1 + {noise})
+
+def test_summary_fixture(array_compare):
+    # A different random draw each time, so only the distribution is compared
+    values = np.random.default_rng({seed}).normal(10, 1, 10 ** 6)
+    array_compare.check(values, file_format='summary', rtol=0.05, write_kwargs={{'sample_size': 0}})
+"""
+
+
+def test_summary_format(pytester):
+    """The summary format compares statistics of the arrays rather than their elements."""
+    pytester.makepyfile(test_summary=TEST_SUMMARY.format(noise=0, seed=1))
+    gen_dir = pytester.path / 'reference'
+    result = pytester.runpytest_subprocess(f'--arraydiff-generate-path={gen_dir}')
+    assert result.ret == 0
+    assert sorted(path.name for path in gen_dir.iterdir()) == ['test_summary_fixture.json', 'test_summary_marker.json']
+    assert (gen_dir / 'test_summary_marker.json').stat().st_size < 100000
+
+    pytester.makepyfile(test_summary=TEST_SUMMARY.format(noise=1e-5, seed=2))
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}')
+    result.assert_outcomes(passed=2)
+
+    pytester.makepyfile(test_summary=TEST_SUMMARY.format(noise=1e-2, seed=3))
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}')
+    result.assert_outcomes(passed=1, failed=1)
+    result.stdout.fnmatch_lines(['*mean: 1.51499* (a) != 1.5000* (b)',
+                                 '*1024 / 1024 sampled elements differ, first at index *'])
+
+
+def test_summarize():
+    from pytest_arraydiff.plugin import SummaryDiff
+
+    array = np.random.default_rng(0).lognormal(size=(300, 400))
+    array[0, :3] = [np.nan, np.inf, -np.inf]
+    summary = SummaryDiff.summarize(array, sample_size=10, relative_accuracy=0.01)
+    finite = array[np.isfinite(array)]
+    assert (summary['count'], summary['nan'], summary['posinf'], summary['neginf']) == (finite.size, 1, 1, 1)
+    np.testing.assert_allclose([summary['min'], summary['max'], summary['mean'], summary['std']],
+                               [finite.min(), finite.max(), finite.mean(), finite.std()], rtol=1e-10)
+    for level, value in summary['quantiles'].items():
+        assert abs(value - np.quantile(finite, float(level), method='lower')) <= 0.01 * value
+    assert summary['sample']['values'] == array.flat[summary['sample']['indices']].tolist()
+    assert SummaryDiff.summarize(array, sample_size=10)['sample'] == summary['sample']
+
+    with pytest.raises(TypeError, match='real numbers'):
+        SummaryDiff.summarize(np.ones(3, dtype=complex))
+
+
+TEST_COMPRESSION = """
+import pytest
+import numpy as np
+
+def values():
+    return np.linspace(0, 1, 1000).reshape((25, 40)) * (1 + {noise})
+
+@pytest.mark.array_compare(file_format='text')
+def test_compressed_text():
+    return values()
+
+@pytest.mark.array_compare(file_format='npy')
+def test_compressed_npy():
+    return values()
+
+@pytest.mark.array_compare(file_format='fits')
+def test_compressed_fits():
+    return values()
+
+@pytest.mark.array_compare(file_format='summary')
+def test_compressed_summary():
+    return values()
+
+@pytest.mark.array_compare(file_format='npy', write_kwargs={{'compression': 'bz2'}})
+def test_compressed_kwargs():
+    return values()
+"""
+
+
+def test_compressed_references(pytester):
+    """Compressed references are written on request and always read."""
+    pytester.makepyfile(test_compression=TEST_COMPRESSION.format(noise=0))
+    gen_dir = pytester.path / 'reference'
+    result = pytester.runpytest_subprocess(f'--arraydiff-generate-path={gen_dir}', '--arraydiff-compression=xz')
+    assert result.ret == 0
+    assert sorted(path.name for path in gen_dir.iterdir()) == [
+        'test_compressed_fits.fits.xz', 'test_compressed_kwargs.npy.bz2', 'test_compressed_npy.npy.xz',
+        'test_compressed_summary.json.xz', 'test_compressed_text.txt.xz']
+
+    # References are found and decompressed whatever the compression option
+    for options in (['--arraydiff-compression=xz'], ['--arraydiff-compression=gz'], []):
+        result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}', *options)
+        result.assert_outcomes(passed=5)
+
+    pytester.makepyfile(test_compression=TEST_COMPRESSION.format(noise=1e-3))
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}')
+    result.assert_outcomes(failed=5)
+
+    # Updated references are compressed as configured
+    result = pytester.runpytest_subprocess('--arraydiff-update', f'--arraydiff-reference-path={gen_dir}',
+                                           '--arraydiff-compression=gz', '-k', 'npy or kwargs')
+    result.assert_outcomes(passed=2, deselected=3)
+    assert sorted(path.name for path in gen_dir.glob('*npy*')) == ['test_compressed_kwargs.npy.bz2',
+                                                                    'test_compressed_npy.npy.gz']
+
+
+@pytest.mark.parametrize('compression', ('gz', 'bz2', 'xz'))
+@pytest.mark.parametrize('order', ('C', 'F'))
+def test_compressed_npy(tmp_path, compression, order):
+    """Compressed npy references are compared while they are decompressed."""
+    from pytest_arraydiff.plugin import NPYDiff, CompressedNPY, _write
+
+    array = np.asarray(np.linspace(0, 1, 5000).reshape((50, 100)), order=order)
+    filename = str(tmp_path / f'reference.npy.{compression}')
+    _write('npy', filename, array, {})
+    reference = NPYDiff.read_reference(filename)
+    assert isinstance(reference, CompressedNPY)
+    np.testing.assert_array_equal(NPYDiff.read(filename), array)
+
+    assert reference.allclose(array, block_size=999)
+    assert reference.allclose(np.ascontiguousarray(array) * (1 + 1e-9), block_size=999)
+    changed = array.copy()
+    changed[-1, -1] += 1e-3
+    assert not reference.allclose(changed, block_size=999)
+    assert not reference.allclose(array[:10])
+
+
+TEST_BLOCKS = """
+import pytest
+import numpy as np
+
+def blocks(rows=1000, block_rows=64):
+    for start in range(0, rows, block_rows):
+        stop = min(start + block_rows, rows)
+        yield np.linspace(start, stop, (stop - start) * 4, endpoint=False).reshape((-1, 4)) * (1 + {noise})
+
+class Chunked:
+    # Minimal stand-in for a Dask array
+    shape = (1000, 4)
+    chunks = ((500, 300, 200), (4,))
+    def __getitem__(self, rows):
+        return np.concatenate(list(blocks()))[rows]
+
+@pytest.mark.array_compare(file_format='text')
+def test_blocks_text():
+    return blocks()
+
+@pytest.mark.array_compare(file_format='npy')
+def test_blocks_npy():
+    return blocks()
+
+@pytest.mark.array_compare(file_format='npy')
+def test_blocks_chunked():
+    return Chunked()
+
+def test_blocks_fixture(array_compare):
+    array_compare.check(blocks(), file_format='npy', filename='test_blocks_npy.npy')
+"""
+
+
+def test_block_outputs(pytester):
+    """Lazy outputs are written and compared one block of rows at a time."""
+    pytester.makepyfile(test_blocks=TEST_BLOCKS.format(noise=0))
+    gen_dir = pytester.path / 'reference'
+    result = pytester.runpytest_subprocess(f'--arraydiff-generate-path={gen_dir}', '-k', 'not fixture')
+    assert result.ret == 0
+    expected = np.concatenate([np.linspace(start, min(start + 64, 1000), min(64, 1000 - start) * 4,
+                                           endpoint=False).reshape((-1, 4)) for start in range(0, 1000, 64)])
+    np.testing.assert_array_equal(np.load(gen_dir / 'test_blocks_npy.npy'), expected)
+    np.testing.assert_array_equal(np.load(gen_dir / 'test_blocks_chunked.npy'), expected)
+    np.testing.assert_allclose(np.loadtxt(gen_dir / 'test_blocks_text.txt'), expected, rtol=1e-5)
+
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}')
+    result.assert_outcomes(passed=4)
+
+    pytester.makepyfile(test_blocks=TEST_BLOCKS.format(noise=1e-3))
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}')
+    result.assert_outcomes(failed=4)
+    result.stdout.fnmatch_lines(['*The output, given as blocks of rows, differs from the reference*',
+                                 '*Rows 0 to 63 differ:*'])
+
+    result = pytester.runpytest_subprocess('--arraydiff-update', f'--arraydiff-reference-path={gen_dir}',
+                                           '-k', 'not fixture')
+    result.assert_outcomes(passed=3)
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}')
+    result.assert_outcomes(passed=4)
+
+
+def test_block_outputs_fixtures(pytester):
+    """Lazy outputs are consumed before the fixtures of the test are torn down."""
+    pytester.makepyfile("""
+        import pytest
+        import numpy as np
+
+        @pytest.fixture
+        def data(tmp_path):
+            np.savetxt(tmp_path / 'data.txt', np.arange(1., 101.))
+            with open(tmp_path / 'data.txt') as f:
+                yield f
+
+        def blocks(data):
+            for _ in range(10):
+                yield np.loadtxt(data, max_rows=10)
+
+        @pytest.mark.array_compare(file_format='npy')
+        def test_lazy(data):
+            return blocks(data)
+    """)
+    gen_dir = pytester.path / 'reference'
+    result = pytester.runpytest_subprocess(f'--arraydiff-generate-path={gen_dir}')
+    assert result.ret == 0
+    result.assert_outcomes(skipped=1)
+    np.testing.assert_array_equal(np.load(gen_dir / 'test_lazy.npy'), np.arange(1., 101.))
+    result = pytester.runpytest_subprocess('--arraydiff', '--arraydiff-async', f'--arraydiff-reference-path={gen_dir}')
+    result.assert_outcomes(passed=1)
+
+
+def test_block_outputs_unsupported(pytester):
+    """Formats that cannot be written in blocks reject iterators."""
+    pytester.makepyfile("""
+        import pytest
+        import numpy as np
+
+        @pytest.mark.array_compare(file_format='fits')
+        def test_blocks_fits():
+            return (np.zeros((2, 3)) for _ in range(3))
+
+        def blocks():
+            yield np.zeros((2, 3))
+            raise RuntimeError("produced when the output is consumed")
+
+        @pytest.mark.array_compare
+        def test_blocks_raise():
+            return blocks()
+    """)
+    result = pytester.runpytest_subprocess('--arraydiff', '-k', 'fits')
+    result.assert_outcomes(failed=1)
+    result.stdout.fnmatch_lines(["*The 'fits' format cannot store outputs given as blocks of rows*"])
+
+    # Without --arraydiff, lazy outputs are still consumed
+    result = pytester.runpytest_subprocess('-k', 'raise')
+    result.assert_outcomes(failed=1)
+    result.stdout.fnmatch_lines(['*produced when the output is consumed*'])
+
+
+@pytest.mark.parametrize('compression', (None, 'gz'))
+def test_write_blocks(tmp_path, compression):
+    """Blocks are written as the array they concatenate to and compared to it."""
+    from pytest_arraydiff.plugin import NPYDiff, TextDiff, _write
+
+    array = np.arange(1., 301.).reshape((100, 3))
+
+    def blocks(scale=1.):
+        return (array[start:start + 7] * scale for start in range(0, 100, 7))
+
+    suffix = '' if compression is None else f'.{compression}'
+    for file_format, diff in (('npy', NPYDiff), ('text', TextDiff)):
+        filename = str(tmp_path / f'reference.{diff.extension}{suffix}')
+        _write(file_format, filename, blocks(), {})
+        np.testing.assert_array_equal(diff.read(filename), array)
+        reference = diff.read_reference(filename)
+        assert diff.compare_blocks(reference, blocks(), atol=0., rtol=1e-7) == (True, "")
+        assert diff.compare_blocks(reference, blocks(1 + 1e-9), atol=0., rtol=1e-7) == (True, "")
+        identical, message = diff.compare_blocks(reference, blocks(1 + 1e-3), atol=0., rtol=1e-7)
+        assert not identical and message.startswith('Rows 0 to 6 differ:')
+        identical, message = diff.compare_blocks(reference, iter([array, array]), atol=0., rtol=1e-7)
+        assert not identical and message == 'Shapes differ: (200, 3) (a) != (100, 3) (b)'
+
+    # The header is the one np.save writes
+    NPYDiff.write_blocks(tmp_path / 'blocks.npy', blocks())
+    np.save(tmp_path / 'array.npy', array)
+    assert (tmp_path / 'blocks.npy').read_bytes() == (tmp_path / 'array.npy').read_bytes()
+
+
+TEST_PERFORMANCE = """
+import time
+import pytest
+import numpy as np
+
+@pytest.mark.array_compare(perf_tolerance=1.5)
+def test_perf_memory():
+    work = np.ones({size})
+    return np.arange(10.) + work[:10] - 1
+
+@pytest.mark.array_compare(perf_tolerance=1.5, file_format='npy')
+def test_perf_time():
+    time.sleep({delay})
+    return np.arange(10.)
+
+@pytest.mark.array_compare
+def test_perf_untracked():
+    time.sleep({delay})
+    return np.ones({size})[:10]
+"""
+
+
+def test_performance_regressions(pytester):
+    """The performance of tests is recorded with the references and checked."""
+    # The recorded time is well above PERFORMANCE_MIN_TIME, so that the
+    # passing comparisons have a comfortable margin on a loaded machine
+    pytester.makepyfile(test_perf=TEST_PERFORMANCE.format(size=2 ** 18, delay=0.5))
+    gen_dir = pytester.path / 'reference'
+    result = pytester.runpytest_subprocess(f'--arraydiff-generate-path={gen_dir}')
+    assert result.ret == 0
+    records = json.loads((gen_dir / 'arraydiff-performance.json').read_text())
+    assert sorted(records) == ['test_perf_memory.txt', 'test_perf_time.npy']
+    assert 2 ** 21 <= records['test_perf_memory.txt']['peak_memory'] < 2 ** 22
+    assert records['test_perf_time.npy']['time'] >= 0.5
+
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}')
+    result.assert_outcomes(passed=3)
+
+    pytester.makepyfile(test_perf=TEST_PERFORMANCE.format(size=2 ** 20, delay=2))
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}')
+    result.assert_outcomes(passed=1, failed=2)
+    result.stdout.fnmatch_lines(['*Performance regression past perf_tolerance=1.5 for test_perf_memory.txt: '
+                                 'peak memory 8* MB, recorded 2* MB*',
+                                 '*Performance regression past perf_tolerance=1.5 for test_perf_time.npy: '
+                                 'wall time 2* s, recorded 0.5* s*'])
+
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}',
+                                           '--arraydiff-perf-warn')
+    result.assert_outcomes(passed=3, warnings=2)
+
+    # A larger tolerance set on the command line only applies to unmarked tests
+    result = pytester.runpytest_subprocess('--arraydiff', f'--arraydiff-reference-path={gen_dir}',
+                                           '--arraydiff-perf-tolerance=100')
+    result.assert_outcomes(passed=1, failed=2)